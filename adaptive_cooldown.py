@@ -0,0 +1,64 @@
+import time
+
+
+class CooldownController:
+    WINDOW = 15.0  # Seconds between adjustments
+
+    def __init__(self, cooldown):
+        """
+        Adaptive cooldown of a guild. Every window, the cooldown is scaled by how far the raves of the window were
+        from the guild's budget of role edits per minute (at most halved or doubled at once), and doubled (or raised
+        to the retry-after) if Discord answered a role edit with a 429.
+
+        :param cooldown: Initial effective cooldown (seconds)
+        """
+        self.effective = cooldown  # Current cooldown (seconds)
+        self.raves = 0  # Raves started in the current window
+        self.retryAfter = 0.0  # Longest retry-after of the 429s of the current window, 0 if there were none
+        self.windowStart = time.monotonic()
+
+    def rave(self):
+        """
+        Count a rave (one role edit)
+
+        :return: None
+        """
+        self.raves += 1
+
+    def rate_limited(self, retry_after):
+        """
+        Note a 429 on one of the guild's role edits
+
+        :param retry_after: Seconds Discord asked to wait
+        :return: None
+        """
+        self.retryAfter = max(self.retryAfter, retry_after)
+
+    def update(self, budget, low, high):
+        """
+        Adjust the cooldown if the current window is over. Cheap enough to call for every rave.
+
+        :param budget: Role edits per minute the guild should stay under
+        :param low: Shortest cooldown allowed (seconds)
+        :param high: Longest cooldown allowed (seconds)
+        :return: True if the cooldown changed
+        """
+        now = time.monotonic()
+        elapsed = now - self.windowStart
+        if elapsed < self.WINDOW:
+            return False
+
+        if self.retryAfter:
+            target = max(self.effective * 2, self.retryAfter)
+        else:
+            rate = self.raves * 60 / elapsed
+            target = self.effective * min(max(rate / budget, 0.5), 2.0)
+        target = round(min(max(target, low), high), 1)
+
+        self.raves = 0
+        self.retryAfter = 0.0
+        self.windowStart = now
+        changed = target != self.effective
+        self.effective = target
+        return changed
+
@@ -0,0 +1,132 @@
+"""
+Cost per rejected message of the on_message admission stage, before (the original string-keyed checks, reproduced
+below) and after (main.on_message).
+
+Usage: python benchmarks/bench_admission.py [iterations]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeGuild, FakeMember, FakeMessage
+
+# Guild state files are created in the working directory
+os.chdir(tempfile.mkdtemp())
+import main
+
+
+legacy_servers = {}
+legacy_opt_out_lists = {}  # The opt-out list was a list of IDs
+legacy_cooldowns = {}  # Per-user cooldowns were a list of member IDs...
+legacy_global_cooldowns = {}  # ...next to a global cooldown flag
+
+
+def legacy_check_server(server):
+    global legacy_servers
+    if server in legacy_servers:
+        rave = legacy_servers[server]
+    return rave
+
+
+async def legacy_on_message(message):
+    """
+    The admission part of the original on_message: every check runs in a fixed order for every message.
+    """
+    member = message.author
+    serverStr = str(message.guild.id)+"."+str(message.guild)
+    rave = legacy_check_server(serverStr)
+
+    isCommand = False
+    isCooldownActive = False
+    isOptedOut = False
+    isRequiredRole = True
+
+    if member == main.bot.user:
+        return
+
+    try:
+        if message.content[0] == '!':
+            isCommand = True
+    except:
+        pass
+
+    # Check if the cooldown is active
+    if rave.useGlobalCooldown:
+        isCooldownActive = legacy_global_cooldowns[serverStr]
+    else:
+        if member.id in legacy_cooldowns[serverStr]:
+            isCooldownActive = True
+
+    if rave.checkRole:
+        isRequiredRole = False
+        for role in member.roles:
+            if role.name == rave.requiredRole:
+                isRequiredRole = True
+                break
+
+    if rave.checkOptOut and member.id in legacy_opt_out_lists[serverStr]:
+        isOptedOut = True
+
+    if rave.enableRave and isRequiredRole and not isCommand and not isCooldownActive and not isOptedOut:
+        raise AssertionError("benchmark message was admitted")
+
+    await main.bot.process_commands(message)
+
+
+async def no_commands(message):
+    pass
+
+
+async def measure(handler, message, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await handler(message)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+async def run(iterations):
+    # Commands are not what is being measured
+    main.bot.process_commands = no_commands
+
+    active = FakeGuild(1, "Active", roles=100)
+    disabled = FakeGuild(2, "Disabled", roles=100)
+    for guild in (active, disabled):
+        rave = main.servers.get(guild)
+        legacy_servers[rave.server] = rave
+        legacy_opt_out_lists[rave.server] = list(rave.opt_out_set)
+        legacy_cooldowns[rave.server] = []
+        legacy_global_cooldowns[rave.server] = False
+    main.servers.find(disabled.id).enableRave = False
+    main.servers.find(disabled.id).save_variables()
+
+    member = FakeMember(10, "member", active, roles=active.roles[1:20])
+    main.servers.find(active.id).cooldowns.start(member.id, 3600, True)
+    legacy_cooldowns[main.servers.find(active.id).server].append(member.id)
+    legacy_global_cooldowns[main.servers.find(active.id).server] = True
+
+    cases = [
+        ("bot author", FakeMessage(FakeMember(11, "bot", active, bot=True), active)),
+        ("command", FakeMessage(member, active, "!help")),
+        ("cooldown", FakeMessage(member, active)),
+        ("rave disabled", FakeMessage(FakeMember(12, "member", disabled, roles=disabled.roles[1:20]), disabled)),
+        ("direct message", FakeMessage(member, None)),
+    ]
+
+    print(f"{'rejected message':<16} {'before (ns)':>12} {'after (ns)':>12}")
+    for name, message in cases:
+        after = await measure(main.on_message, message, iterations)
+        if message.guild is None:
+            # The original handler raised AttributeError on direct messages
+            before = "crash"
+        else:
+            before = f"{await measure(legacy_on_message, message, iterations):.0f}"
+        print(f"{name:<16} {before:>12} {after:>12.0f}")
+
+    await main.writer.flush()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
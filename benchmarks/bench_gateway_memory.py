@@ -0,0 +1,111 @@
+"""
+Memory kept by discord.py's cache per 10k guild members under each gateway profile of gateway.py, plus "members"
+(the default profile with the privileged members intent, so every member is cached). Synthetic GUILD_CREATE and
+MESSAGE_CREATE payloads are fed straight to a ConnectionState; no connection to Discord is made.
+
+Usage: python benchmarks/bench_gateway_memory.py [--members N] [--roles N] [--messages N]
+"""
+import os
+import sys
+import gc
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import discord
+from discord.state import ConnectionState
+from gateway import gateway_options, PROFILES
+
+GUILD_ID = 1 << 40
+CHANNEL_ID = GUILD_ID + 1
+TIMESTAMP = "2021-01-01T00:00:00+00:00"
+
+
+def options_of(profile):
+    """
+    :param profile: A gateway profile, or "members"
+    :return: The ConnectionState options of the profile
+    """
+    if profile == "members":
+        return {"intents": discord.Intents.all(), "member_cache_flags": discord.MemberCacheFlags.all()}
+    options = dict(gateway_options(profile))
+    options.setdefault("intents", discord.Intents.default())
+    return options
+
+
+def user_payload(i):
+    return {"id": str(GUILD_ID + 1000 + i), "username": f"member{i}", "discriminator": f"{i % 10000:04d}",
+            "avatar": None}
+
+
+def member_payload(i, roles):
+    return {"user": user_payload(i), "roles": [str(GUILD_ID + 100 + (i + j) % roles) for j in range(3)],
+            "joined_at": TIMESTAMP, "deaf": False, "mute": False}
+
+
+def guild_payload(members, roles):
+    return {
+        "id": str(GUILD_ID), "name": "Guild", "owner_id": str(GUILD_ID + 1000), "member_count": members,
+        "large": True, "unavailable": False,
+        "roles": [
+            {"id": str(GUILD_ID if i == 0 else GUILD_ID + 100 + i), "name": "@everyone" if i == 0 else f"Role {i}",
+             "permissions": "0", "position": i, "color": 0, "hoist": False, "managed": False, "mentionable": False}
+            for i in range(roles)
+        ],
+        "channels": [{"id": str(CHANNEL_ID), "type": 0, "name": "general", "position": 0,
+                      "permission_overwrites": []}],
+        "members": [member_payload(i, roles) for i in range(members)],
+    }
+
+
+def message_payload(i, members, roles):
+    member = member_payload(i % members, roles)
+    author = member.pop("user")
+    return {"id": str(GUILD_ID + 10 ** 7 + i), "channel_id": str(CHANNEL_ID), "guild_id": str(GUILD_ID),
+            "author": author, "member": member, "content": "hello", "timestamp": TIMESTAMP,
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+            "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "type": 0}
+
+
+def measure(profile, guild, messages):
+    """
+    :param profile: A gateway profile, or "members"
+    :param guild: GUILD_CREATE payload
+    :param messages: MESSAGE_CREATE payloads
+    :return: (bytes kept, members cached, messages cached)
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, syncer=None, http=None, loop=None,
+                            **options_of(profile))
+    state.parse_guild_create(guild)
+    for message in messages:
+        state.parse_message_create(message)
+
+    gc.collect()
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    cached_guild = state._get_guild(GUILD_ID)
+    return kept, len(cached_guild.members), len(state._messages or ())
+
+
+def run(args):
+    guild = guild_payload(args.members, args.roles)
+    messages = [message_payload(i, args.members, args.roles) for i in range(args.messages)]
+    scale = 10000 / args.members
+
+    print(f"{args.members} members, {args.roles} roles, {args.messages} messages\n")
+    print(f"{'profile':<10} {'KiB per 10k members':>20} {'members cached':>15} {'messages cached':>16}")
+    for profile in ("members",) + PROFILES:
+        kept, members, cached = measure(profile, guild, messages)
+        print(f"{profile:<10} {kept * scale / 1024:>20,.0f} {members:>15} {cached:>16}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory kept per 10k members by each gateway profile")
+    parser.add_argument("--members", type=int, default=10000, help="members in the guild")
+    parser.add_argument("--roles", type=int, default=200, help="roles in the guild")
+    parser.add_argument("--messages", type=int, default=5000, help="messages received")
+    run(parser.parse_args())
@@ -0,0 +1,146 @@
+"""
+Offline micro-benchmarks of the on_message hot path and the code around it, using the fake guilds, members and
+stubbed HTTP layer of benchmarks/fakes.py instead of Discord.
+
+Usage: python benchmarks/bench_hot_path.py [--guilds N] [--roles N] [--opt-outs N] [--blacklist N] [--ops N]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeGuild, FakeMember, FakeMessage, FakeHTTP
+
+# Guild state files are created in the working directory
+os.chdir(tempfile.mkdtemp())
+import main
+import storage
+import color_sampler
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of values
+    :param fraction: Percentile wanted, between 0 and 1
+    :return: The value at that percentile
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def measure(name, operation, ops):
+    """
+    Run operation ops times, timing every call, then ops more times under tracemalloc to count allocations.
+    Prints one result line.
+
+    :param name: Name of the benchmark
+    :param operation: Function called with the iteration number; may return an awaitable
+    :param ops: Number of calls
+    :return: None
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i in range(ops):
+        before = time.perf_counter_ns()
+        result = operation(i)
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(time.perf_counter_ns() - before)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.reset_peak()
+    for i in range(ops):
+        result = operation(i)
+        if asyncio.iscoroutine(result):
+            await result
+    retained = (sys.getallocatedblocks() - blocks) / ops
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    print(f"{name:<32} {ops / elapsed:>12,.0f} {percentile(latencies, 0.5) / 1000:>9.1f} "
+          f"{percentile(latencies, 0.99) / 1000:>9.1f} {retained:>11.2f} {peak / 1024:>10.1f}")
+
+
+async def run(args):
+    random.seed(0)
+    http = FakeHTTP()
+    guilds = [FakeGuild(i + 1, f"Guild {i}", roles=args.roles, http=http) for i in range(args.guilds)]
+    members = []
+    for guild in guilds:
+        guild.roles[1].name = "Server Booster"
+        rave = main.servers.get(guild)
+        rave.useGlobalCooldown = False
+        rave.cooldownTime = 0
+        rave.roleQueue.bucket.limit = rave.roleQueue.bucket.remaining = 10 ** 9  # The stubbed API has no rate limit
+        rave.opt_out_set.update(range(10 ** 6, 10 ** 6 + args.opt_outs))
+        rave.blacklist = [
+            [(random.randrange(256), random.randrange(256), random.randrange(256)), round(random.uniform(0.01, 0.3), 2)]
+            for _ in range(args.blacklist)
+        ]
+        rave.generate_blacklist_range()
+        rave.resolve_required_role(guild)
+        rave.save_variables()
+        main.storage.save_opt_out(rave.server, list(rave.opt_out_set))
+        members.append([FakeMember(guild.id * 100 + j, f"member{j}", guild, roles=guild.roles[1:20]) for j in range(50)])
+    await main.writer.flush()
+
+    admitted = [FakeMessage(members[i % len(guilds)][i // len(guilds) % 50], guilds[i % len(guilds)]) for i in range(997)]
+    opted_out = []
+    for guild in guilds:
+        member = FakeMember(10 ** 6, "opted out", guild, roles=guild.roles[1:20])
+        opted_out.append(FakeMessage(member, guild))
+
+    rave = main.servers.find(guilds[0].id)
+    opt_out_name = f"opt_out_{rave.server}"
+
+    print(f"{args.guilds} guilds, {args.roles} roles per guild, {args.opt_outs} opt-outs, "
+          f"{args.blacklist} blacklisted colors, {args.ops} operations\n")
+    print(f"{'benchmark':<32} {'ops/s':>12} {'p50 (us)':>9} {'p99 (us)':>9} {'blocks/op':>11} {'peak (KiB)':>10}")
+
+    await measure("on_message (raves)", lambda i: main.on_message(admitted[i % len(admitted)]), args.ops)
+    queued = sum(main.servers.find(guild.id).roleQueue.depth for guild in guilds)
+    await measure("on_message (opted out)", lambda i: main.on_message(opted_out[i % len(opted_out)]), args.ops)
+    await measure("color sampling", lambda i: rave.colorSampler.sample(), args.ops)
+    await measure("generate_blacklist_range", lambda i: rave.generate_blacklist_range(), max(args.ops // 100, 10))
+    rave.blacklistMode = "lab"
+    await measure("build_lab_table", lambda i: color_sampler.build_lab_table(rave.blacklist), max(args.ops // 1000, 5))
+    await measure("generate_blacklist_range (lab)", lambda i: rave.generate_blacklist_range(), max(args.ops // 100, 10))
+    await measure("color sampling (lab)", lambda i: rave.colorSampler.sample(), args.ops)
+    await measure("blacklist check (lab)", lambda i: rave.colorSampler.allows(i * 2654435761 & 0xFFFFFF), args.ops)
+    rave.blacklistMode = "box"
+    rave.colorMode = "palette"
+    rave.generate_blacklist_range()
+    await measure("color sampling (palette)", lambda i: rave.colorSampler.sample(i), args.ops)
+    rave.colorMode = "random"
+    rave.generate_blacklist_range()
+    await measure("check_server (servers.get)", lambda i: main.servers.get(guilds[i % len(guilds)]), args.ops)
+    await measure("load_file (opt-out list)", lambda i: storage.load_file(opt_out_name), max(args.ops // 100, 10))
+    await measure("save_variables", lambda i: rave.save_variables(), args.ops)
+    await measure("save_variables + flush", lambda i: flush_variables(rave), max(args.ops // 100, 10))
+
+    # Let the role queues drain to count the API calls the raves cost
+    while any(main.servers.find(guild.id).roleQueue.depth for guild in guilds):
+        await asyncio.sleep(0.01)
+    print(f"\nrole updates queued after the rave benchmark: {queued}, API calls made: {len(http.calls)}")
+
+
+async def flush_variables(rave):
+    rave.save_variables()
+    await main.writer.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the on_message hot path")
+    parser.add_argument("--guilds", type=int, default=10, help="number of guilds")
+    parser.add_argument("--roles", type=int, default=100, help="roles per guild")
+    parser.add_argument("--opt-outs", type=int, default=1000, help="opt-out list size per guild")
+    parser.add_argument("--blacklist", type=int, default=10, help="blacklisted colors per guild")
+    parser.add_argument("--ops", type=int, default=20000, help="operations per benchmark")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,125 @@
+import asyncio
+import discord
+
+
+class FakeHTTP:
+    def __init__(self, latency=0.0):
+        """
+        Stubbed HTTP layer: records the API calls made through the fake objects, optionally taking latency seconds
+        to answer each one.
+        """
+        self.latency = latency
+        self.calls = []  # (route, detail) of every call made
+
+    async def request(self, route, detail=None):
+        self.calls.append((route, detail))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeRole:
+    def __init__(self, guild, role_id, name, position, colour=0):
+        """
+        Stand-in for discord.Role with the attributes and calls main.py uses.
+        """
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.position = position
+        self.colour = colour if isinstance(colour, discord.Colour) else discord.Colour(colour)
+        self.managed = False
+
+    def __str__(self):
+        return self.name
+
+    def __lt__(self, other):
+        return self.position < other.position
+
+    async def edit(self, **fields):
+        await self.guild.http.request("edit_role", self.id)
+        if "colour" in fields:
+            self.colour = fields["colour"]
+        if "name" in fields:
+            self.name = fields["name"]
+
+    async def delete(self, reason=None):
+        await self.guild.http.request("delete_role", self.id)
+        self.guild.roles.remove(self)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name="Guild", roles=0, http=None):
+        """
+        Stand-in for discord.Guild.
+
+        :param guild_id: ID of the guild
+        :param name: Name of the guild
+        :param roles: Number of filler roles to create
+        :param http: FakeHTTP recording the API calls, a new one by default
+        """
+        self.id = guild_id
+        self.name = name
+        self.http = http if http is not None else FakeHTTP()
+        self.members = []
+        self.chunked = False  # Whether members lists every member
+        self.me = None
+        self.roles = [FakeRole(self, guild_id, "@everyone", 0)]
+        for i in range(roles):
+            self.roles.append(FakeRole(self, (guild_id << 16) + i + 1, f"Role {i}", i + 1))
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def calls(self):
+        return self.http.calls
+
+    async def create_role(self, name, colour=0, **fields):
+        await self.http.request("create_role", name)
+        role = FakeRole(self, (self.id << 16) + len(self.roles) + 1, name, len(self.roles), colour)
+        self.roles.append(role)
+        return role
+
+    async def edit_role_positions(self, positions):
+        await self.http.request("edit_role_positions", len(positions))
+        for role, position in positions.items():
+            role.position = position
+
+
+class FakeMember:
+    def __init__(self, member_id, name, guild=None, roles=(), bot=False):
+        """
+        Stand-in for discord.Member.
+        """
+        self.id = member_id
+        self.name = name
+        self.discriminator = f"{member_id % 10000:04d}"
+        self.guild = guild
+        self.roles = list(roles)
+        self._roles = discord.utils.SnowflakeList([role.id for role in self.roles])
+        self.bot = bot
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+    async def add_roles(self, *roles):
+        await self.guild.http.request("add_roles", self.id)
+        self.roles.extend(roles)
+        for role in roles:
+            self._roles.add(role.id)
+
+    async def remove_roles(self, *roles):
+        await self.guild.http.request("remove_roles", self.id)
+        ids = {role.id for role in roles}
+        self.roles = [role for role in self.roles if role.id not in ids]
+        self._roles = discord.utils.SnowflakeList([role.id for role in self.roles])
+
+
+class FakeMessage:
+    def __init__(self, author, guild, content="hello"):
+        """
+        Stand-in for discord.Message.
+        """
+        self.author = author
+        self.guild = guild
+        self.content = content
@@ -0,0 +1,420 @@
+"""
+End-to-end replay harness. Guild and message events, recorded from a running bot (RECORD_EVENTS) or generated with
+`synth`, are replayed at a chosen speed into the bot's full path: discord.py's gateway parsing, on_message, the role
+queues and discord.py's HTTP client. The HTTP client talks to a local stand-in for the Discord API that emulates the
+role create/edit/position and add-role routes with per-route rate limits (headers and 429s), and sends back the role
+events the gateway would.
+
+Usage:
+    python benchmarks/replay.py synth <events file> [--guilds N] [--members N] [--messages N] [--rate N] ...
+    python benchmarks/replay.py run <events file> [--speed N] [--limit N] [--window N] [--latency N] ...
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from event_log import read_events
+
+BOT_ID = 1000
+BOOSTER_ROLE = "Server Booster"
+TIMESTAMP = "2021-01-01T00:00:00+00:00"
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of values
+    :param fraction: Percentile wanted, between 0 and 1
+    :return: The value at that percentile, or 0 if there are no values
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def json_response(data, status=200, headers=None):
+    from aiohttp import web
+
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode(), status=status,
+                        headers=dict(headers or {}, **{"Content-Type": "application/json"}))
+
+
+def role_payload(role_id, name, position, color=0):
+    return {"id": str(role_id), "name": name, "permissions": "0", "position": position, "color": color,
+            "hoist": False, "managed": False, "mentionable": False}
+
+
+def synth(args):
+    """
+    Write a synthetic event stream: GUILD_CREATEs at time 0, then messages arriving at random (Poisson) at a given
+    rate, most of them from a small share of talkative members.
+
+    :param args: Parsed arguments
+    :return: None
+    """
+    rng = random.Random(args.seed)
+    with open(args.file, "w") as file:
+        for g in range(args.guilds):
+            guild_id = (g + 1) << 32
+            roles = [role_payload(guild_id, "@everyone", 0), role_payload(guild_id + 1, BOOSTER_ROLE, 1)]
+            roles += [role_payload(guild_id + 2 + i, f"Role {i}", 2 + i) for i in range(args.roles)]
+            guild = {"id": str(guild_id), "name": f"Guild {g}", "owner_id": str(guild_id + 100), "large": True,
+                     "member_count": args.members, "roles": roles,
+                     "channels": [{"id": str(guild_id + 99), "type": 0, "name": "general", "position": 0,
+                                   "permission_overwrites": []}]}
+            file.write(json.dumps({"t": 0.0, "op": "GUILD_CREATE", "d": guild}) + "\n")
+
+        now = 0.0
+        talkative = max(int(args.members * args.hot_members), 1)
+        for i in range(args.messages):
+            now += rng.expovariate(args.rate)
+            g = rng.randrange(args.guilds)
+            guild_id = (g + 1) << 32
+            if rng.random() < args.hot_share:
+                m = rng.randrange(talkative)
+            else:
+                m = rng.randrange(args.members)
+            member_id = guild_id + 100 + m
+            content = "!color" if rng.random() < args.commands else ""
+            message = {
+                "id": str((1 << 40) + i), "channel_id": str(guild_id + 99), "guild_id": str(guild_id),
+                "author": {"id": str(member_id), "username": f"member{m}", "discriminator": f"{m % 10000:04d}",
+                           "avatar": None},
+                "member": {"roles": [str(guild_id + 1)] if m % 2 == 0 else [], "joined_at": TIMESTAMP},
+                "content": content, "timestamp": TIMESTAMP, "type": 0
+            }
+            file.write(json.dumps({"t": round(now, 6), "op": "MESSAGE_CREATE", "d": message}) + "\n")
+    print(f"Wrote {args.guilds} guilds and {args.messages} messages over {now:.1f} s to {args.file}.")
+
+
+class FakeDiscord:
+    def __init__(self, state, limit, window, latency, fail_rate):
+        """
+        Stand-in for the Discord REST API, holding the guilds' roles. Each route of each guild is a rate-limit
+        bucket allowing limit requests per window seconds.
+
+        :param state: The bot's ConnectionState, which the role events are sent to
+        :param limit: Requests allowed per bucket and window
+        :param window: Length of a rate-limit window (seconds)
+        :param latency: Time taken to answer each request (seconds)
+        :param fail_rate: Share of the requests answered with a 429 regardless of the buckets
+        """
+        self.state = state
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.failRate = fail_rate
+        self.roles = {}  # Guild ID -> {role ID: role payload}
+        self.nextId = 1 << 50
+        self.buckets = {}  # (method, route, guild ID) -> [remaining, reset time]
+        self.calls = Counter()  # "METHOD route" -> requests
+        self.rateLimited = Counter()  # "METHOD route" -> requests answered with a 429
+        self.memberRoles = {}  # (guild ID, member ID) -> role IDs added through the API
+        self.names = {}  # (guild ID, "name#discriminator") -> member ID
+        self.lastMessage = {}  # Member ID -> time of the member's latest message
+        self.waiting = {}  # Member ID -> time of the member's oldest queued rave not yet sent to the API
+        self.latencies = []  # Seconds from a message to the request recoloring its author's role
+        self.routes = [
+            ("GET", "/users/@me", self.get_me),
+            ("POST", "/guilds/{guild}/roles", self.create_role),
+            ("PATCH", "/guilds/{guild}/roles", self.move_roles),
+            ("PATCH", "/guilds/{guild}/roles/{role}", self.edit_role),
+            ("DELETE", "/guilds/{guild}/roles/{role}", self.delete_role),
+            ("PUT", "/guilds/{guild}/members/{member}/roles/{role}", self.add_role),
+            ("DELETE", "/guilds/{guild}/members/{member}/roles/{role}", self.remove_role),
+            ("PATCH", "/guilds/{guild}/members/{member}", self.edit_member),
+            ("POST", "/channels/{channel}/messages", self.send_message),
+        ]
+        self.patterns = [re.compile("^" + re.sub(r"{\w+}", r"(\\d+)", template) + "$") for _, template, _ in self.routes]
+
+    def add_guild(self, data):
+        self.roles[int(data["id"])] = {int(role["id"]): dict(role) for role in data["roles"]}
+
+    def message_received(self, data):
+        """
+        Note the time of a replayed message, and give its author the roles added to them so far, as Discord would
+
+        :param data: MESSAGE_CREATE payload, updated in place
+        :return: None
+        """
+        guild_id, member_id = int(data["guild_id"]), int(data["author"]["id"])
+        author = data["author"]
+        self.names[(guild_id, f"{author['username']}#{author['discriminator']}")] = member_id
+        added = self.memberRoles.get((guild_id, member_id))
+        if added:
+            data["member"]["roles"] = list({*data["member"]["roles"], *(str(role_id) for role_id in added)})
+        self.lastMessage[member_id] = time.perf_counter()
+
+    def queued(self, member_id):
+        """
+        Note that a member's latest message was queued as a rave (called from RoleQueue.post)
+
+        :param member_id: ID of the member
+        :return: None
+        """
+        if member_id in self.lastMessage:
+            self.waiting.setdefault(member_id, self.lastMessage[member_id])
+
+    def recolored(self, guild_id, role):
+        """
+        Record the latency of a request setting the color of a member's role
+
+        :param guild_id: ID of the guild
+        :param role: Role payload, with its new name
+        :return: None
+        """
+        member_id = self.names.get((guild_id, role["name"]))
+        start = self.waiting.pop(member_id, None)
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+
+    def gateway(self, event, data):
+        """
+        Send a gateway event to the bot once the current request has been answered
+
+        :param event: Event name, e.g. "guild_role_create"
+        :param data: Event payload
+        :return: None
+        """
+        asyncio.get_event_loop().call_soon(getattr(self.state, "parse_" + event), data)
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        path = "/" + request.match_info["path"]
+        for (method, template, handler), pattern in zip(self.routes, self.patterns):
+            match = pattern.match(path)
+            if method == request.method and match:
+                break
+        else:
+            return json_response({"message": "404: Not Found", "code": 0}, status=404)
+
+        route = f"{method} {template}"
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # Per-route, per-guild bucket
+        now = time.monotonic()
+        key = (method, template, match.group(1) if match.groups() else None)
+        bucket = self.buckets.get(key)
+        if bucket is None or now >= bucket[1]:
+            bucket = self.buckets[key] = [self.limit, now + self.window]
+        if bucket[0] <= 0 or random.random() < self.failRate:
+            self.rateLimited[route] += 1
+            retry_after = max(bucket[1] - now, 0.05)
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": retry_after * 1000, "global": False},
+                status=429, headers={"Retry-After": f"{retry_after:.3f}", "Via": "1.1 fake-discord"}
+            )
+        bucket[0] -= 1
+        headers = {
+            "X-RateLimit-Limit": str(self.limit), "X-RateLimit-Remaining": str(bucket[0]),
+            "X-RateLimit-Reset": f"{time.time() + bucket[1] - now:.3f}",
+            "X-RateLimit-Reset-After": f"{bucket[1] - now:.3f}", "X-RateLimit-Bucket": f"{key[0]}:{key[1]}",
+        }
+
+        body = await request.json() if request.can_read_body else {}
+        result = handler(body, *(int(group) for group in match.groups()))
+        if result is None:
+            return web.Response(status=204, headers=headers)
+        return json_response(result, headers=headers)
+
+    def get_me(self, body):
+        return {"id": str(BOT_ID), "username": "RoleRave", "discriminator": "0001", "avatar": None, "bot": True}
+
+    def create_role(self, body, guild_id):
+        roles = self.roles[guild_id]
+        self.nextId += 1
+        role = role_payload(self.nextId, body.get("name", "new role"), len(roles), body.get("color", 0))
+        roles[self.nextId] = role
+        self.recolored(guild_id, role)
+        self.gateway("guild_role_create", {"guild_id": str(guild_id), "role": role})
+        return role
+
+    def move_roles(self, body, guild_id):
+        roles = self.roles[guild_id]
+        for change in body:
+            role = roles.get(int(change["id"]))
+            if role is not None:
+                role["position"] = change["position"]
+                self.gateway("guild_role_update", {"guild_id": str(guild_id), "role": dict(role)})
+        return list(roles.values())
+
+    def edit_role(self, body, guild_id, role_id):
+        role = self.roles[guild_id][role_id]
+        role.update({key: value for key, value in body.items() if key in ("name", "color", "hoist", "mentionable")})
+        if "color" in body:
+            self.recolored(guild_id, role)
+        self.gateway("guild_role_update", {"guild_id": str(guild_id), "role": dict(role)})
+        return role
+
+    def delete_role(self, body, guild_id, role_id):
+        self.roles[guild_id].pop(role_id, None)
+        self.gateway("guild_role_delete", {"guild_id": str(guild_id), "role_id": str(role_id)})
+
+    def add_role(self, body, guild_id, member_id, role_id):
+        self.memberRoles.setdefault((guild_id, member_id), set()).add(role_id)
+
+    def remove_role(self, body, guild_id, member_id, role_id):
+        self.memberRoles.get((guild_id, member_id), set()).discard(role_id)
+
+    def edit_member(self, body, guild_id, member_id):
+        if "roles" in body:
+            self.memberRoles[(guild_id, member_id)] = {int(role_id) for role_id in body["roles"]}
+
+    def send_message(self, body, channel_id):
+        self.nextId += 1
+        return {"id": str(self.nextId), "channel_id": str(channel_id), "content": body.get("content", ""),
+                "author": self.get_me(body), "timestamp": TIMESTAMP, "edited_timestamp": None, "tts": False,
+                "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+                "embeds": body.get("embeds", []), "pinned": False, "type": 0}
+
+
+async def replay(args, main, events):
+    from aiohttp import web
+    from discord.user import ClientUser
+    from rave_config import parse_changes
+
+    state = main.bot._connection
+    state._chunk_guilds = False
+    fake = FakeDiscord(state, args.limit, args.window, args.latency, args.fail_rate)
+
+    app = web.Application()
+    app.router.add_route("*", "/api/v7/{path:.*}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    main.discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v7"
+
+    # Time raves from the message that queued them
+    post = main.RoleQueue.post
+
+    def traced_post(queue, key, colour, apply):
+        queued = post(queue, key, colour, apply)
+        if queued:
+            fake.queued(key)
+        return queued
+
+    main.RoleQueue.post = traced_post
+
+    me = await main.bot.http.static_login("replay", bot=True)
+    state.user = ClientUser(state=state, data=me)
+    change = parse_changes(args.config.split()) if args.config else None
+
+    # Bots don't rave, so the bot's own member doesn't matter; guilds come first so messages find them
+    messages = 0
+    start = time.perf_counter()
+    for at, event, data in events:
+        delay = at / args.speed - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if event == "GUILD_CREATE":
+            data = dict(data, members=[], unavailable=False)
+            fake.add_guild(data)
+            state.parse_guild_create(data)
+            guild = state._get_guild(int(data["id"]))
+            rave = main.servers.get(guild)
+            if change is not None:
+                rave.apply_config(guild, change)
+        elif event == "MESSAGE_CREATE":
+            data = dict(data, member=dict(data.get("member", {})))
+            for key, default in (("edited_timestamp", None), ("tts", False), ("mention_everyone", False),
+                                 ("pinned", False)):
+                data.setdefault(key, default)
+            for key in ("mentions", "mention_roles", "attachments", "embeds"):
+                data.setdefault(key, [])
+            fake.message_received(data)
+            state.parse_message_create(data)
+            messages += 1
+    replayed = time.perf_counter() - start
+
+    # Let the queues drain
+    deadline = time.perf_counter() + args.drain
+    while any(rave.roleQueue.depth for rave in main.servers) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+    drained = time.perf_counter() - start
+
+    report(args, main, fake, messages, replayed, drained)
+
+    # Stop what is still waiting for the API before the stand-in goes away
+    tasks = [task for rave in main.servers for task in (rave.roleQueue.worker, rave.rolePool.task)
+             if task is not None and not task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await main.writer.flush()
+    await main.bot.http.close()
+    await runner.cleanup()
+
+
+def report(args, main, fake, messages, replayed, drained):
+    queues = [rave.roleQueue.stats() for rave in main.servers]
+    posted = sum(queue["posted"] for queue in queues)
+    coalesced = sum(queue["coalesced"] for queue in queues)
+    shed = sum(queue["shed"] for queue in queues)
+    total = sum(fake.calls.values())
+    role_calls = total - fake.calls["POST /channels/{channel}/messages"] - fake.calls["GET /users/@me"]
+    latencies = sorted(fake.latencies)
+
+    print(f"Replayed {messages} messages in {replayed:.1f} s (speed x{args.speed}), drained after {drained:.1f} s")
+    print(f"Rate limit: {args.limit} requests per {args.window} s per route and guild, "
+          f"{args.latency * 1000:.0f} ms latency, {args.fail_rate:.0%} forced 429s\n")
+    print(f"API calls: {total} ({total / max(messages, 1) * 1000:.1f} per 1000 messages), "
+          f"role calls: {role_calls} ({role_calls / max(messages, 1) * 1000:.1f} per 1000 messages)")
+    for route, count in fake.calls.most_common():
+        print(f"    {route:<52} {count:>8} {fake.rateLimited[route]:>6} x 429")
+    print(f"\nRaves queued: {posted}, merged: {coalesced} ({coalesced / max(posted, 1):.1%}), "
+          f"shed: {shed} ({shed / max(posted, 1):.1%})")
+    print(f"Recolor latency over {len(latencies)} recolors: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, max {percentile(latencies, 1.0) * 1000:.0f} ms")
+    print(f"Raves still unsent at the end: {len(fake.waiting)}")
+
+
+def run(args):
+    events = read_events(args.file)
+
+    # Guild state files are created in the working directory
+    os.chdir(tempfile.mkdtemp())
+    import main
+    main.bot.loop.run_until_complete(replay(args, main, events))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record/replay harness against a local stand-in Discord API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    synth_parser = commands.add_parser("synth", help="write a synthetic event stream")
+    synth_parser.add_argument("file", help="events file to write")
+    synth_parser.add_argument("--guilds", type=int, default=5, help="number of guilds")
+    synth_parser.add_argument("--members", type=int, default=500, help="members per guild")
+    synth_parser.add_argument("--roles", type=int, default=50, help="filler roles per guild")
+    synth_parser.add_argument("--messages", type=int, default=5000, help="number of messages")
+    synth_parser.add_argument("--rate", type=float, default=100.0, help="messages per second, all guilds together")
+    synth_parser.add_argument("--hot-members", type=float, default=0.05, help="share of talkative members")
+    synth_parser.add_argument("--hot-share", type=float, default=0.8, help="share of messages they send")
+    synth_parser.add_argument("--commands", type=float, default=0.01, help="share of messages that are !color")
+    synth_parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+    run_parser = commands.add_parser("run", help="replay an event stream and report")
+    run_parser.add_argument("file", help="events file to replay")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    run_parser.add_argument("--limit", type=int, default=10, help="requests per route, guild and window")
+    run_parser.add_argument("--window", type=float, default=10.0, help="rate-limit window (seconds)")
+    run_parser.add_argument("--latency", type=float, default=0.0, help="API latency (seconds)")
+    run_parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    run_parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait for the queues to drain")
+    run_parser.add_argument("--config", default="", help="!config set arguments applied to every guild, e.g. "
+                                                         "\"cooldownTime=5 useGlobalCooldown=off\"")
+
+    parsed = parser.parse_args()
+    synth(parsed) if parsed.command == "synth" else run(parsed)
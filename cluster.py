@@ -0,0 +1,115 @@
+"""
+Supervisor for running the bot as several worker processes, each connecting a range of the gateway shards.
+
+Usage: python cluster.py <shard count> <cluster count>
+
+Every worker runs main.py with SHARD_COUNT, CLUSTER_COUNT and CLUSTER_ID set, and is restarted if it exits.
+"""
+import os
+import sys
+import time
+import signal
+import subprocess
+
+
+def cluster_shard_ids(shard_count, cluster_count, cluster_id):
+    """
+    Shards connected by one cluster: the shards are split into cluster_count contiguous ranges
+
+    :param shard_count: Total number of shards
+    :param cluster_count: Number of worker processes
+    :param cluster_id: Index of this worker (0 to cluster_count - 1)
+    :return: List of shard IDs
+    """
+    start = shard_count * cluster_id // cluster_count
+    end = shard_count * (cluster_id + 1) // cluster_count
+    return list(range(start, end))
+
+
+class Worker:
+    def __init__(self, shard_count, cluster_count, cluster_id):
+        """
+        One bot process of the cluster, restarted with a growing delay when it keeps crashing.
+        """
+        self.env = dict(
+            os.environ,
+            SHARD_COUNT=str(shard_count),
+            CLUSTER_COUNT=str(cluster_count),
+            CLUSTER_ID=str(cluster_id)
+        )
+        self.clusterId = cluster_id
+        self.process = None
+        self.startedAt = 0.0
+        self.restartAt = 0.0  # Time before which a crashed worker is not restarted
+        self.delay = 1.0  # Restart delay, doubled on every quick crash
+
+    def start(self):
+        print(f"Starting cluster {self.clusterId}...")
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        self.process = subprocess.Popen([sys.executable, main_path], env=self.env)
+        self.startedAt = time.monotonic()
+
+    def check(self):
+        """
+        Restart the worker if it exited
+
+        :return: None
+        """
+        now = time.monotonic()
+        if self.process is not None:
+            code = self.process.poll()
+            if code is None:
+                return
+            print(f"Cluster {self.clusterId} exited with code {code}.")
+            self.process = None
+
+            # A worker that ran for a while gets restarted quickly again
+            self.delay = 1.0 if now - self.startedAt > 60 else min(self.delay * 2, 60.0)
+            self.restartAt = now + self.delay
+        if now >= self.restartAt:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+
+def supervise(shard_count, cluster_count):
+    """
+    Launch every worker and keep them running until interrupted
+
+    :param shard_count: Total number of shards
+    :param cluster_count: Number of worker processes
+    :return: None
+    :raises ValueError: if some workers would have no shard to connect
+    """
+    if not 1 <= cluster_count <= shard_count:
+        raise ValueError(f"The cluster count must be between 1 and the shard count ({shard_count})")
+    workers = [Worker(shard_count, cluster_count, i) for i in range(cluster_count)]
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    try:
+        while not stopping:
+            for worker in workers:
+                worker.check()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    # Let the workers flush their state before exiting
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        if worker.process is not None:
+            try:
+                worker.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    supervise(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,337 @@
+import random
+import hashlib
+import colorsys
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+class NoAllowedColorsError(Exception):
+    """
+    Raised when the blacklist covers every color
+    """
+    pass
+
+
+class ColorSampler:
+    def __init__(self, blacklist_range):
+        """
+        Precomputed set of the colors allowed by a blacklist, sampled uniformly in O(log n).
+
+        The RGB cube is cut into cells along the boundaries of the blacklisted boxes (first by red, then by green
+        within each red slab). Every cell is either entirely inside or entirely outside of each box, so all that is
+        left to store per cell is the list of blue intervals that no box covers.
+
+        :param blacklist_range: 2-tuples of inclusive (r, g, b) minimums and maximums, as built by
+            Rave.generate_blacklist_range
+        """
+        boxes = [(lo[0], lo[1], lo[2], hi[0] + 1, hi[1] + 1, hi[2] + 1) for lo, hi in blacklist_range]
+        self.boxes = boxes  # Half-open (r, g, b) minimums and maximums of the blacklisted boxes
+
+        self.cells = []  # (r, r width, g, g width, [(b start, b length)], [cumulative b lengths]) of allowed cells
+        self.starts = []  # Index of the first color of each cell, for bisecting
+        self.total = 0  # Number of allowed colors
+
+        r_bounds = sorted({0, 256}.union(*((b[0], b[3]) for b in boxes)))
+        for r_lo, r_hi in zip(r_bounds, r_bounds[1:]):
+            r_boxes = [b for b in boxes if b[0] <= r_lo and r_hi <= b[3]]
+
+            g_bounds = sorted({0, 256}.union(*((b[1], b[4]) for b in r_boxes)))
+            for g_lo, g_hi in zip(g_bounds, g_bounds[1:]):
+                g_boxes = [b for b in r_boxes if b[1] <= g_lo and g_hi <= b[4]]
+                intervals = self.free_intervals(sorted((b[2], b[5]) for b in g_boxes))
+                if not intervals:
+                    continue
+
+                cumulative = []
+                b_length = 0
+                for interval in intervals:
+                    cumulative.append(b_length)
+                    b_length += interval[1]
+
+                self.cells.append((r_lo, r_hi - r_lo, g_lo, g_hi - g_lo, intervals, cumulative))
+                self.starts.append(self.total)
+                self.total += (r_hi - r_lo) * (g_hi - g_lo) * b_length
+
+    @staticmethod
+    def free_intervals(covered):
+        """
+        Complement of a sorted list of covered half-open intervals within 0-255
+
+        :param covered: Sorted list of (start, end) tuples
+        :return: List of (start, length) tuples that are not covered
+        """
+        intervals = []
+        position = 0
+        for start, end in covered:
+            if start > position:
+                intervals.append((position, start - position))
+            position = max(position, end)
+        if position < 256:
+            intervals.append((position, 256 - position))
+        return intervals
+
+    def allows(self, color):
+        """
+        :param color: Hex value of a color stored in an integer
+        :return: Whether the blacklist allows the color
+        """
+        r, g, b = color >> 16, color >> 8 & 255, color & 255
+        return not any(box[0] <= r < box[3] and box[1] <= g < box[4] and box[2] <= b < box[5] for box in self.boxes)
+
+    def sample(self, member_id=None):
+        """
+        Draw a color uniformly among the allowed ones
+
+        :param member_id: ID of the member raving (unused; see PaletteSampler)
+        :return: Hex value of the color stored in an integer
+        """
+        if self.total == 0:
+            raise NoAllowedColorsError
+        index = random.randrange(self.total)
+
+        cell = bisect_right(self.starts, index) - 1
+        r_lo, r_width, g_lo, g_width, intervals, cumulative = self.cells[cell]
+        offset = index - self.starts[cell]
+
+        b_length = cumulative[-1] + intervals[-1][1]
+        b_offset = offset % b_length
+        offset //= b_length
+        color_g = g_lo + offset % g_width
+        color_r = r_lo + offset // g_width
+
+        interval = bisect_right(cumulative, b_offset) - 1
+        color_b = intervals[interval][0] + b_offset - cumulative[interval]
+
+        return color_r * 65536 + color_g * 256 + color_b
+
+
+LUT_BITS = 5  # Bits kept per channel by the lookup table of LabColorSampler
+LUT_SIDE = 1 << LUT_BITS
+CELL_BITS = 8 - LUT_BITS
+CELL_SIDE = 1 << CELL_BITS  # Width of a lookup table cell, per channel
+LAB_TABLE_BYTES = LUT_SIDE ** 3 // 8  # Size of a lookup table, a bit per cell
+LAB_TABLE_VERSION = 1  # Bump whenever build_lab_table changes what it computes (e.g. the ΔE formula)
+lab_cells = None  # CIELAB coordinates of the center of every cell, sorted by L, computed on first use
+MAX_LAB_TABLES = 256  # Lookup tables kept in memory (4 KiB each)
+lab_tables = OrderedDict()  # Blacklist key -> lookup table, least recently used first; shared by the guilds
+lab_tables_lock = threading.Lock()  # Tables are built in executor threads
+
+
+def srgb_to_lab(r, g, b):
+    """
+    Convert an sRGB color to CIELAB (D65 white point)
+
+    :param r: Red, 0-255 (floats allowed)
+    :param g: Green, 0-255
+    :param b: Blue, 0-255
+    :return: (L, a, b) tuple
+    """
+    def linear(channel):
+        channel /= 255
+        return channel / 12.92 if channel <= 0.04045 else ((channel + 0.055) / 1.055) ** 2.4
+
+    def f(t):
+        return t ** (1 / 3) if t > 216 / 24389 else (24389 / 27 * t + 16) / 116
+
+    r, g, b = linear(r), linear(g), linear(b)
+    fx = f((0.4124564 * r + 0.3575761 * g + 0.1804375 * b) / 0.95047)
+    fy = f(0.2126729 * r + 0.7151522 * g + 0.0721750 * b)
+    fz = f((0.0193339 * r + 0.1191920 * g + 0.9503041 * b) / 1.08883)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+
+def get_lab_cells():
+    """
+    :return: ([L of every cell], [(L, a, b, cell index) of every cell]), both sorted by L
+    """
+    global lab_cells
+    if lab_cells is None:
+        cells = []
+        half = (CELL_SIDE - 1) / 2
+        for index in range(LUT_SIDE ** 3):
+            r, g, b = index >> 2 * LUT_BITS, index >> LUT_BITS & LUT_SIDE - 1, index & LUT_SIDE - 1
+            cells.append(srgb_to_lab(r * CELL_SIDE + half, g * CELL_SIDE + half, b * CELL_SIDE + half) + (index,))
+        cells.sort()
+        lab_cells = ([cell[0] for cell in cells], cells)
+    return lab_cells
+
+
+def lab_table_key(blacklist):
+    """
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :return: Hashable key of the blacklist
+    """
+    return tuple((tuple(color), tolerance) for color, tolerance in blacklist)
+
+
+def lab_table_tag(blacklist):
+    """
+    Identify the lookup table this version of build_lab_table builds for a blacklist, so a saved table can be told
+    apart from one built for another blacklist or by another version
+
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :return: Hex digest of the table version, the table size and the blacklist
+    """
+    blacklist = [[[int(c) for c in color], float(tolerance)] for color, tolerance in blacklist]
+    return hashlib.sha1(repr((LAB_TABLE_VERSION, LUT_BITS, blacklist)).encode()).hexdigest()
+
+
+def build_lab_table(blacklist):
+    """
+    Build the lookup table of LabColorSampler. Pure Python and slow (tens of milliseconds per blacklisted color), so
+    it is best run in an executor thread; see get_lab_table.
+
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :return: 4 KiB bit table with a bit per cell, set if the cell is blacklisted
+    """
+    blocked = bytearray(LAB_TABLE_BYTES)
+    keys, cells = get_lab_cells()
+    for color, tolerance in blacklist:
+        l0, a0, b0 = srgb_to_lab(*color)
+        radius = tolerance * 100
+        limit = radius * radius
+        # |ΔL| never exceeds ΔE, so only the cells within the L window can be close enough
+        for l1, a1, b1, index in cells[bisect_right(keys, l0 - radius):bisect_right(keys, l0 + radius)]:
+            if (l1 - l0) ** 2 + (a1 - a0) ** 2 + (b1 - b0) ** 2 <= limit:
+                blocked[index >> 3] |= 1 << (index & 7)
+    return bytes(blocked)
+
+
+def find_lab_table(blacklist):
+    """
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :return: The blacklist's cached lookup table, or None if it isn't cached
+    """
+    key = lab_table_key(blacklist)
+    with lab_tables_lock:
+        table = lab_tables.get(key)
+        if table is not None:
+            lab_tables.move_to_end(key)
+    return table
+
+
+def store_lab_table(blacklist, table):
+    """
+    Cache the lookup table of a blacklist, e.g. one saved with a guild's settings
+
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :param table: Table built by build_lab_table
+    :return: None
+    """
+    with lab_tables_lock:
+        lab_tables[lab_table_key(blacklist)] = table
+        if len(lab_tables) > MAX_LAB_TABLES:
+            lab_tables.popitem(last=False)
+
+
+def get_lab_table(blacklist):
+    """
+    :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+    :return: The blacklist's lookup table, built and cached if it wasn't already
+    """
+    table = find_lab_table(blacklist)
+    if table is None:
+        table = build_lab_table(blacklist)
+        store_lab_table(blacklist, table)
+    return table
+
+
+class LabColorSampler:
+    def __init__(self, blacklist):
+        """
+        Colors allowed by a blacklist in perceptual mode: a color is blacklisted when its CIELAB distance (ΔE*76) to
+        a blacklisted color is below 100 times the tolerance (so the default 0.2 is a ΔE of 20).
+
+        The RGB cube is quantized into 32x32x32 cells of 8x8x8 colors, judged by their center. The blocked cells are
+        kept as a 4 KiB bit table, so checking a color is a single lookup however long the blacklist is. Tables are
+        cached per blacklist (see get_lab_table), and only built here if no one prepared the table beforehand.
+
+        :param blacklist: [(r, g, b), tolerance] list of blacklisted colors
+        """
+        self.blocked = get_lab_table(blacklist)  # Bit per cell, set if the cell is blacklisted
+
+        self.free = [index for index in range(LUT_SIDE ** 3) if not self.blocked[index >> 3] >> (index & 7) & 1]
+        self.total = len(self.free) * CELL_SIDE ** 3  # Number of allowed colors
+
+    def allows(self, color):
+        """
+        :param color: Hex value of a color stored in an integer
+        :return: Whether the blacklist allows the color
+        """
+        index = (color >> 16 + CELL_BITS) << 2 * LUT_BITS \
+            | (color >> 8 + CELL_BITS & LUT_SIDE - 1) << LUT_BITS \
+            | (color >> CELL_BITS & LUT_SIDE - 1)
+        return not self.blocked[index >> 3] >> (index & 7) & 1
+
+    def sample(self, member_id=None):
+        """
+        Draw a color uniformly among the allowed ones
+
+        :param member_id: ID of the member raving (unused; see PaletteSampler)
+        :return: Hex value of the color stored in an integer
+        """
+        if self.total == 0:
+            raise NoAllowedColorsError
+        index = random.choice(self.free)
+        offset = random.randrange(CELL_SIDE ** 3)
+        color_r = (index >> 2 * LUT_BITS) * CELL_SIDE + (offset >> 2 * CELL_BITS)
+        color_g = (index >> LUT_BITS & LUT_SIDE - 1) * CELL_SIDE + (offset >> CELL_BITS & CELL_SIDE - 1)
+        color_b = (index & LUT_SIDE - 1) * CELL_SIDE + (offset & CELL_SIDE - 1)
+        return color_r * 65536 + color_g * 256 + color_b
+
+
+def hue_palette(count, saturation=0.8, value=0.95):
+    """
+    Evenly spaced hues
+
+    :param count: Number of colors
+    :param saturation: HSV saturation of the colors
+    :param value: HSV value of the colors
+    :return: List of the colors' hex values stored in integers
+    """
+    colors = []
+    for i in range(count):
+        r, g, b = colorsys.hsv_to_rgb(i / count, saturation, value)
+        colors.append(round(r * 255) * 65536 + round(g * 255) * 256 + round(b * 255))
+    return colors
+
+
+class PaletteSampler:
+    MAX_MEMBERS = 10000  # Members whose last color is remembered in shuffle order before starting over
+
+    def __init__(self, colors, order="cycle"):
+        """
+        Fixed palette of colors, generated (and checked against the blacklist) once, so picking a color is a single
+        array read.
+
+        :param colors: Hex values of the colors, already filtered by the blacklist
+        :param order: "cycle" to hand the colors out in turn, "shuffle" to give each member a random color different
+            from their previous one
+        """
+        self.colors = array("I", colors)
+        self.order = order
+        self.total = len(self.colors)  # Number of allowed colors
+        self.cursor = 0  # Next color in cycle order
+        self.last = {}  # Member ID -> index of the member's last color, in shuffle order
+
+    def sample(self, member_id=None):
+        """
+        Hand out the next color of the palette
+
+        :param member_id: ID of the member raving, to avoid repeating their last color in shuffle order
+        :return: Hex value of the color stored in an integer
+        """
+        if self.total == 0:
+            raise NoAllowedColorsError
+        if self.order == "shuffle" and member_id is not None and self.total > 1:
+            last = self.last.get(member_id)
+            index = random.randrange(self.total) if last is None else (last + random.randrange(1, self.total)) % self.total
+            if len(self.last) >= self.MAX_MEMBERS:
+                self.last.clear()
+            self.last[member_id] = index
+        else:
+            index = self.cursor
+            self.cursor = (index + 1) % self.total
+        return self.colors[index]
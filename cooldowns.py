@@ -0,0 +1,51 @@
+import time
+
+
+class Cooldowns:
+    def __init__(self):
+        """
+        Cooldown deadlines of a guild. Nothing waits for a cooldown to end: a cooldown is active while its deadline
+        (a time.monotonic() timestamp) is in the future, and expired deadlines are simply ignored.
+        """
+        self.deadlines = {}  # Member ID -> end of the member's cooldown
+        self.globalDeadline = 0.0  # End of the global cooldown
+        self.pruneAt = 64  # Number of stored deadlines at which expired ones get dropped
+
+    def active(self, member_id, use_global):
+        """
+        Check whether a cooldown is active
+
+        :param member_id: ID of the member sending the message
+        :param use_global: Whether to check the global cooldown instead of the member's
+        :return: True if the cooldown has not ended yet
+        """
+        if use_global:
+            return time.monotonic() < self.globalDeadline
+        return time.monotonic() < self.deadlines.get(member_id, 0.0)
+
+    def start(self, member_id, duration, use_global):
+        """
+        Start a cooldown
+
+        :param member_id: ID of the member who raved
+        :param duration: Cooldown time (seconds)
+        :param use_global: Whether to start the global cooldown instead of the member's
+        :return: None
+        """
+        deadline = time.monotonic() + duration
+        if use_global:
+            self.globalDeadline = deadline
+        else:
+            self.deadlines[member_id] = deadline
+            if len(self.deadlines) >= self.pruneAt:
+                self.prune()
+
+    def prune(self):
+        """
+        Drop expired deadlines. Called when the dict doubles in size, so the cost is amortized over the inserts.
+
+        :return: None
+        """
+        now = time.monotonic()
+        self.deadlines = {k: v for k, v in self.deadlines.items() if v > now}
+        self.pruneAt = max(64, 2 * len(self.deadlines))
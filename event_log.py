@@ -0,0 +1,67 @@
+"""
+Recording of the gateway events the bot's hot path depends on (GUILD_CREATE and MESSAGE_CREATE), one JSON object per
+line, for benchmarks/replay.py. Only what replaying needs is kept: guilds lose their members, presences and voice
+states, and messages lose their content unless it is a command.
+"""
+import json
+import time
+
+RECORDED_EVENTS = ("GUILD_CREATE", "MESSAGE_CREATE")
+GUILD_FIELDS = ("id", "name", "owner_id", "roles", "channels", "member_count", "large")
+MESSAGE_FIELDS = ("id", "channel_id", "guild_id", "author", "member", "content", "timestamp", "type")
+
+
+class EventRecorder:
+    def __init__(self, path):
+        """
+        Appends the recorded events to a file, with their time relative to the first one.
+
+        :param path: Path of the file
+        """
+        self.file = open(path, "a", buffering=1)
+        self.start = None  # time.monotonic() of the first event
+
+    async def on_socket_response(self, msg):
+        """
+        Listener of discord.py's socket_response event, which carries every raw gateway payload
+
+        :param msg: The payload
+        :return: None
+        """
+        event = msg.get("t")
+        if event not in RECORDED_EVENTS:
+            return
+        data = msg.get("d") or {}
+        if event == "GUILD_CREATE":
+            data = {key: data[key] for key in GUILD_FIELDS if key in data}
+        else:
+            if "guild_id" not in data:
+                return
+            data = {key: data[key] for key in MESSAGE_FIELDS if key in data}
+            if not data.get("content", "").startswith('!'):
+                data["content"] = ""
+
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        self.file.write(json.dumps({"t": round(now - self.start, 6), "op": event, "d": data}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def read_events(path):
+    """
+    Read a file written by EventRecorder (or by benchmarks/replay.py synth)
+
+    :param path: Path of the file
+    :return: List of (time, event name, payload), in time order
+    """
+    events = []
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                event = json.loads(line)
+                events.append((event["t"], event["op"], event["d"]))
+    events.sort(key=lambda event: event[0])
+    return events
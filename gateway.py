@@ -0,0 +1,32 @@
+"""
+Gateway profiles: the intents and caches the bot asks discord.py for.
+
+"default" keeps discord.py's defaults. "lean" only subscribes to what the bot uses (guilds, their roles and channels,
+and guild messages) and caches no members and no messages. Message authors come with their roles in the message
+payload, so on_message, !color and the permission checks of the admin commands work without a member cache.
+"""
+import discord
+
+PROFILES = ("default", "lean")
+
+
+def gateway_options(profile):
+    """
+    Client options of a gateway profile
+
+    :param profile: "default" or "lean"
+    :return: Dict of keyword arguments for the bot's constructor
+    """
+    if profile == "default":
+        return {}
+    if profile == "lean":
+        intents = discord.Intents.none()
+        intents.guilds = True  # Guilds, roles, channels and the role events
+        intents.guild_messages = True  # on_message and commands
+        return {
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags.none(),
+            "chunk_guilds_at_startup": False,
+            "max_messages": None,
+        }
+    raise ValueError(f"Unknown gateway profile {profile}, expected one of {', '.join(PROFILES)}")
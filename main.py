@@ -1,68 +1,36 @@
+import io
 import os
+import logging
 import discord
-import random
 import asyncio
-import json
+import copy
+import base64
 import traceback
 from dotenv import load_dotenv
 from discord.ext import commands
+from role_queue import RoleQueue, PendingBudget
+from color_sampler import ColorSampler, LabColorSampler, PaletteSampler, NoAllowedColorsError, hue_palette, \
+    get_lab_table, find_lab_table, store_lab_table, lab_table_tag, LAB_TABLE_BYTES
+from cooldowns import Cooldowns
+from adaptive_cooldown import CooldownController
+from persistence import WriteBehind
+from storage import create_storage, write_snapshot, read_snapshot
+from role_index import RoleIndex
+from registry import RaveRegistry
+from role_pool import RolePool
+from role_gc import RoleSweeper
+from role_buckets import BucketRoles
+from cluster import cluster_shard_ids
+from gateway import gateway_options
+from event_log import EventRecorder
+from rave_config import ConfigError, SETTINGS, parse_changes, parse_import, export_config
+import metrics
 
 # Load bot token
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
 
-def create_old_file(filename):
-    """
-    Renames filename to filename_old. Appends numbers if filename_old exists
-
-    :param filename: Name of the file (without extension) to process
-    :return: None
-    """
-    newname = filename + "_old.json"
-    num = 1
-    while os.path.exists(newname):
-        newname = filename + "_old" + str(num) + ".json"
-        num += 1
-    os.rename(filename + ".json", newname)
-
-
-def load_file(filename):
-    """
-    Handles loading a json file, including cases where the file doesn't exist or is corrupted.
-
-    :param filename: Name of the file without extension
-    :return: A list generated from the json data in the file.
-    """
-    file_list = []
-    try:
-        print(f"Opening {filename}.json... ", end='')
-        file = open(f"{filename}.json", "r")
-        file_list = json.load(file)
-        file.close()
-    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-        print("error:")
-
-        # Create it if it is missing
-        if isinstance(e, FileNotFoundError):
-            print(f"File {filename}.json not found, creating it... ", end='')
-
-        # Recreate it if the file is bad
-        elif isinstance(e, json.decoder.JSONDecodeError):
-            print(f"WARNING: {filename}.json file corrupted, re-creating it... ", end='')
-            file.close()
-            create_old_file(filename)
-
-        # Initialize the file
-        file = open(f"{filename}.json", "w")
-        json.dump([], file)
-        file.close()
-        file_list = []
-    finally:
-        print("done.")
-        return file_list
-
-
 def process_boolean(arg, boolean):
     """
     Assists in processing commands to set boolean values
@@ -83,49 +51,236 @@ def process_boolean(arg, boolean):
         return boolean
 
 
+def process_env_boolean(name, default=False):
+    """
+    Reads an on/true or off/false setting from the environment
+
+    :param name: Name of the environment variable
+    :param default: Value used when the variable is not set
+    :return: true/false according to the variable
+    """
+    return process_boolean(os.getenv(name), default)
+
+
+# Storage backend ("json" files per guild, or one "sqlite" database)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+STORAGE_PATH = os.getenv('STORAGE_PATH', 'rolerave.db')
+
+# Guilds kept in memory at once, and seconds after which an unused guild is unloaded
+MAX_RESIDENT_GUILDS = int(os.getenv('MAX_RESIDENT_GUILDS', '10000'))
+GUILD_IDLE_TTL = float(os.getenv('GUILD_IDLE_TTL', '3600'))
+
+# Sharding: set SHARDED to use an AutoShardedBot, and SHARD_COUNT (plus CLUSTER_COUNT and CLUSTER_ID when started by
+# cluster.py) to only connect this process's range of the shards
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', '1'))
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+SHARDED = process_env_boolean('SHARDED') or SHARD_COUNT is not None
+
+# Set METRICS_PORT to serve Prometheus metrics on METRICS_HOST:METRICS_PORT
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Gateway profile: "default" (discord.py's intents and caches) or "lean" (guild and guild message events only, with no
+# member or message cache; memory no longer grows with the guilds' membership). See gateway.py
+GATEWAY_PROFILE = os.getenv('GATEWAY_PROFILE', 'default')
+
+# Maximum number of rave color changes waiting for the API across all guilds; more are shed. The per-guild limit is
+# set with !queue_limit
+MAX_PENDING_RAVES = int(os.getenv('MAX_PENDING_RAVES', '5000'))
+
+# Set RECORD_EVENTS to a file to record the guild and message events received, for benchmarks/replay.py
+RECORD_EVENTS = os.getenv('RECORD_EVENTS')
+
+# Set WARM_START to load every guild's state off the event loop when the bot connects, and to write a snapshot of the
+# loaded guilds at clean shutdown that the next start restores in one read
+WARM_START = process_env_boolean('WARM_START')
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', f"snapshot_{CLUSTER_ID}.json")
+
+# Seconds between sweeps for stale rave roles in the loaded guilds that turned on !role_gc (0 to never sweep), and the
+# most roles deleted per guild and sweep
+ROLE_GC_INTERVAL = float(os.getenv('ROLE_GC_INTERVAL', '3600'))
+ROLE_GC_BATCH = int(os.getenv('ROLE_GC_BATCH', '10'))
+
+
+
+class RaveBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    async def close(self):
+        """
+        Flushes pending writes before disconnecting.
+
+        :return: None
+        """
+        await writer.flush()
+        if WARM_START:
+            await asyncio.get_event_loop().run_in_executor(
+                None, write_snapshot, SNAPSHOT_PATH,
+                {rave.server: (list(rave.opt_out_set), copy.deepcopy(rave.variables_list)) for rave in servers}
+            )
+        storage.close()
+        await super().close()
+
 
 # Bot object with command prefix
-bot = commands.Bot(
-    command_prefix='!',
-    help_command=None
-)
-
-# Servers list
-servers = {}
-
-def check_server(server):
-    global servers
-    if server in servers:
-        rave = servers[server]
-    else:
-        rave = Rave(server)
-        servers[server] = rave
-    return rave
+if SHARD_COUNT is not None:
+    bot = RaveBot(
+        command_prefix='!',
+        help_command=None,
+        shard_count=SHARD_COUNT,
+        shard_ids=cluster_shard_ids(SHARD_COUNT, CLUSTER_COUNT, CLUSTER_ID),
+        **gateway_options(GATEWAY_PROFILE)
+    )
+else:
+    bot = RaveBot(
+        command_prefix='!',
+        help_command=None,
+        **gateway_options(GATEWAY_PROFILE)
+    )
+
+if RECORD_EVENTS:
+    recorder = EventRecorder(RECORD_EVENTS)
+    bot.add_listener(recorder.on_socket_response, 'on_socket_response')
+
+# Guild state storage, and the debounced writer saving to it
+storage = create_storage(STORAGE_BACKEND, STORAGE_PATH)
+writer = WriteBehind()
+
+def cooldown_rate_limited(retry_after, guild_id, path):
+    """
+    Feed a 429 on one of a guild's role edits to its adaptive cooldown
+
+    :param retry_after: Seconds Discord asked to wait
+    :param guild_id: ID of the guild, or None
+    :param path: Route path of the request
+    :return: None
+    """
+    rave = servers.find(guild_id) if guild_id is not None and "/roles" in path else None
+    if rave is not None:
+        rave.cooldownController.rate_limited(retry_after)
+
+# 429s that discord.py retries by itself are only logged
+logging.getLogger("discord.http").addHandler(metrics.RateLimitLogHandler(cooldown_rate_limited))
+
+# Budget of pending rave color changes shared by every guild's role queue
+pendingBudget = PendingBudget(MAX_PENDING_RAVES)
+
+def has_role_id(member, role_id):
+    """
+    Check whether a member has a role by testing the member's raw role-ID list, without building Role objects
+
+    :param member: The member
+    :param role_id: ID of the role
+    :return: True if the member has the role
+    """
+    return member._roles.has(role_id)
+
+def can_unload(rave):
+    """
+    Whether a guild's Rave can be unloaded: it must have no queued or running role work and no unsaved changes
+
+    :param rave: The guild's Rave
+    :return: True if nothing would be lost by unloading it
+    """
+    return rave.roleQueue.depth == 0 \
+        and (rave.roleQueue.worker is None or rave.roleQueue.worker.done()) \
+        and not rave.roleSweeper.sweeping \
+        and (rave.rolePool.task is None or rave.rolePool.task.done()) \
+        and (rave.bucketRoles.task is None or rave.bucketRoles.task.done()) \
+        and not writer.is_pending(("variables", rave.server)) \
+        and not writer.is_pending(("opt_out_journal", rave.server))
+
+def server_name(guild):
+    """
+    :param guild: The guild
+    :return: Name under which the guild's state is stored
+    """
+    return str(guild.id)+"."+str(guild)
+
+def load_state(server):
+    """
+    Read a guild's saved state from storage. Safe to call from an executor thread.
+
+    :param server: Server string
+    :return: (opt-out list, variables list)
+    """
+    return storage.load_opt_out(server), storage.load_variables(server)
+
+def load_known_state(server):
+    """
+    Read a guild's saved state from storage, if it has any, without creating files for it. Safe to call from an
+    executor thread.
+
+    :param server: Server string
+    :return: (opt-out list, variables list), or None if the guild has no saved state
+    """
+    if not storage.has_guild(server):
+        return None
+    state = load_state(server)
+    return state if any(state) else None
 
 class Rave:
-    def __init__(self, server):
-        self.cooldown = []  # Per-User cooldown status
-        self.globalCooldown = False  # Global cooldown status
-        self.server = str(server)
+    def __init__(self, guild, state=None):
+        self.cooldowns = Cooldowns()  # Per-user and global cooldown deadlines
+        self.guildId = guild.id
+        self.server = server_name(guild)  # Name under which the guild's state is stored
+        self.rejection = None  # Admission check for rave messages, compiled from the settings
 
         self.useGlobalCooldown = True  # Set to True to use the global cooldown
         self.cooldownTime = 30  # Cooldown time (seconds)
+        self.adaptiveCooldown = False  # Adjust the cooldown to the guild's edit budget instead of using cooldownTime
+        self.cooldownMin = 5  # Shortest adaptive cooldown (seconds)
+        self.cooldownMax = 300  # Longest adaptive cooldown (seconds)
+        self.editBudget = 20  # Role edits per minute the adaptive cooldown aims for
+        self.cooldownController = CooldownController(self.cooldownTime)  # Effective adaptive cooldown
         self.checkRole = True  # Require the users to have the required role for role rave
         self.requiredRole = "Server Booster"  # Required role for the role rave
+        self.requiredRoleId = None  # ID of the required role, resolved from its name (None if it doesn't exist)
         self.useRequiredRole = False  # Whether or not to use the required role for the role rave
+        self.useBuckets = False  # Whether or not to move members between shared bucket roles instead of using their own
+        self.bucketCount = 8  # Number of bucket roles
+        self.bucketRotate = 60  # Seconds between bucket color changes (0: never)
         self.checkOptOut = True  # Check if the user opted out
         self.enableRave = True  # Do the role rave shenanigans
         self.moveRole = False  # Whether or not to move rave roles
         self.moveRoleAmt = 2  # How much to move roles from top (negative values: from bottom)
+        self.usePool = False  # Whether or not to keep spare rave roles ready for first-time ravers
+        self.poolSize = 5  # Number of spare rave roles to keep ready
+        self.queueLimit = 50  # Maximum number of color changes waiting for the API; more are shed
+        self.roleGc = False  # Whether or not to delete stale rave roles in the background
+        self.roleIdleDays = 30  # Days without a rave after which a rave role is stale (0: never)
 
         # Variables for regulating blacklisted color ranges
         self.blacklist = []  # [(r, g, b), tolerance] list of blacklisted colors and matching tolerances BB: [(46, 204, 113), 0.2], [(52, 152, 219), 0.2]
         self.blacklist_range = []  # 2-tuples of (r, g, b) tuples of blacklisted colors, each indicating a blacklisted range
         self.defaultTolerance = 0.2  # Default amount which a color is allowed to differ from a blacklisted one
+        self.blacklistMode = "box"  # "box": per-channel ranges around blacklisted colors; "lab": perceptual distance
+        self.colorMode = "random"  # "random": any allowed color; "palette": colors of a fixed palette
+        self.paletteHues = 12  # Number of evenly spaced hues in the palette, unless paletteColors is set
+        self.paletteColors = []  # Hex values of the palette's colors; empty to use evenly spaced hues
+        self.paletteOrder = "cycle"  # "cycle": palette colors in turn; "shuffle": random, never twice in a row per member
+        self.colorSampler = ColorSampler([])  # Allowed colors, rebuilt along with blacklist_range
+        self.noColorsLogged = False  # Whether a rave found no allowed colors since colorSampler was rebuilt
+
+        # Name -> role and ID -> role index of the guild's roles, filled on first use
+        self.roleIndex = RoleIndex()
+
+        # Pending role updates, drained by a worker at the pace of the guild's rate-limit bucket
+        self.roleQueue = RoleQueue(limit=self.queueLimit, budget=pendingBudget)
+        self.roleQueue.onRateLimited = self.cooldownController.rate_limited
+
+        # Spare rave roles, already created and moved
+        self.rolePool = RolePool()
 
-        # Load files
-        self.opt_out_list = load_file("opt_out_"+self.server)
-        self.variables_list = load_file("variables_"+self.server)
+        # Finds stale rave roles; knows when each rave role was last used
+        self.roleSweeper = RoleSweeper()
+
+        # Shared color roles, when useBuckets is on
+        self.bucketRoles = BucketRoles()
+
+        # Load saved state, unless it was preloaded by warm_start
+        opt_out_list, self.variables_list = state if state is not None else load_state(self.server)
+        self.opt_out_set = {int(member_id) for member_id in opt_out_list}
+        self.optOutChanges = []  # (member ID, opted out) changes not yet appended to the journal
 
         # Load saved vairables unless variables_list is empty
         if self.variables_list == []:
@@ -135,10 +290,17 @@ class Rave:
 
         # Create blacklisted ranges
         self.generate_blacklist_range()
+        if self.blacklistMode == "lab" and dict(self.variables_list).get("labTable") != self.saved_lab_table():
+            # Saved without a table, or with one built for another blacklist or version: save the current one, so
+            # it is only built on the event loop once
+            self.save_variables()
+        self.resolve_required_role(guild)
+        self.rolePool.load(guild.roles)
+        self.bucketRoles.load(guild.roles)
 
     def save_variables(self):
         """
-        Save the variables to variables.json
+        Save the variables to storage. They are written in the background after a short delay.
 
         :return: None
         """
@@ -146,21 +308,71 @@ class Rave:
         self.variables_list = [
             ("useGlobalCooldown", self.useGlobalCooldown),
             ("cooldownTime", self.cooldownTime),
+            ("adaptiveCooldown", self.adaptiveCooldown),
+            ("cooldownMin", self.cooldownMin),
+            ("cooldownMax", self.cooldownMax),
+            ("editBudget", self.editBudget),
+            ("effectiveCooldown", self.cooldownController.effective),
             ("checkRole", self.checkRole),
             ("requiredRole", self.requiredRole),
             ("useRequiredRole", self.useRequiredRole),
+            ("useBuckets", self.useBuckets),
+            ("bucketCount", self.bucketCount),
+            ("bucketRotate", self.bucketRotate),
             ("checkOptOut", self.checkOptOut),
             ("enableRave", self.enableRave),
             ("blacklist", self.blacklist),
             ("blacklist_range", self.blacklist_range),
             ("defaultTolerance", self.defaultTolerance),
+            ("blacklistMode", self.blacklistMode),
+            ("colorMode", self.colorMode),
+            ("paletteHues", self.paletteHues),
+            ("paletteColors", self.paletteColors),
+            ("paletteOrder", self.paletteOrder),
             ("moveRole", self.moveRole),
-            ("moveRoleAmt", self.moveRoleAmt)
+            ("moveRoleAmt", self.moveRoleAmt),
+            ("usePool", self.usePool),
+            ("poolSize", self.poolSize),
+            ("queueLimit", self.queueLimit),
+            ("roleGc", self.roleGc),
+            ("roleIdleDays", self.roleIdleDays),
+            ("roleLastRave", [[role_id, day] for role_id, day in self.roleSweeper.lastRave.items()]),
+            ("labTable", self.saved_lab_table())
         ]
+        self.roleQueue.limit = self.queueLimit
+        self.roleSweeper.unsaved = False
+        self.compile_admission()
+
+        writer.mark_dirty(("variables", self.server), lambda: copy.deepcopy(self.variables_list),
+                          lambda variables_list: storage.save_variables(self.server, variables_list))
+
+    def set_opt_out(self, member_id, opted_out):
+        """
+        Opt a member out of or back into the rave. Only the change is saved: it is appended to the guild's opt-out
+        journal in the background after a short delay.
 
-        variables_file = open(f"variables_{self.server}.json", "w")
-        json.dump(self.variables_list, variables_file)
-        variables_file.close()
+        :param member_id: ID of the member
+        :param opted_out: True to opt out, False to opt back in
+        :return: False if the member already was in that state, True otherwise
+        """
+        if (member_id in self.opt_out_set) == opted_out:
+            return False
+        if opted_out:
+            self.opt_out_set.add(member_id)
+        else:
+            self.opt_out_set.discard(member_id)
+
+        self.optOutChanges.append((member_id, opted_out))
+        writer.mark_dirty(("opt_out_journal", self.server), self.take_opt_out_changes,
+                          lambda changes: storage.append_opt_out(self.server, changes))
+        return True
+
+    def take_opt_out_changes(self):
+        """
+        :return: The opt-out changes not yet handed to the writer, oldest first
+        """
+        changes, self.optOutChanges = self.optOutChanges, []
+        return changes
 
     def load_variables(self):
         """
@@ -168,23 +380,210 @@ class Rave:
 
         :return: None
         """
+        labTable = None  # Saved lookup table of the blacklist, cached once the blacklist is known
         # global variables_list
         # global useGlobalCooldown, cooldownTime, checkRole, checkOptOut, enableRave
         for v in self.variables_list:
             if v[0] == "useGlobalCooldown": self.useGlobalCooldown = v[1]
             if v[0] == "cooldownTime": self.cooldownTime = v[1]
+            if v[0] == "adaptiveCooldown": self.adaptiveCooldown = v[1]
+            if v[0] == "cooldownMin": self.cooldownMin = v[1]
+            if v[0] == "cooldownMax": self.cooldownMax = v[1]
+            if v[0] == "editBudget": self.editBudget = v[1]
+            if v[0] == "effectiveCooldown": self.cooldownController.effective = v[1]
             if v[0] == "checkRole": self.checkRole = v[1]
             if v[0] == "requiredRole": self.requiredRole = v[1]
             if v[0] == "useRequiredRole": self.useRequiredRole = v[1]
+            if v[0] == "useBuckets": self.useBuckets = v[1]
+            if v[0] == "bucketCount": self.bucketCount = v[1]
+            if v[0] == "bucketRotate": self.bucketRotate = v[1]
             if v[0] == "checkOptOut": self.checkOptOut = v[1]
             if v[0] == "enableRave": self.enableRave = v[1]
-            if v[0] == "blacklist": self.blacklist = v[1]
+            if v[0] == "blacklist": self.blacklist = [[tuple(color), tolerance] for color, tolerance in v[1]]
             if v[0] == "blacklist_range": self.blacklist_range = v[1]
             if v[0] == "defaultTolerance": self.defaultTolerance = v[1]
+            if v[0] == "blacklistMode": self.blacklistMode = v[1]
+            if v[0] == "colorMode": self.colorMode = v[1]
+            if v[0] == "paletteHues": self.paletteHues = v[1]
+            if v[0] == "paletteColors": self.paletteColors = v[1]
+            if v[0] == "paletteOrder": self.paletteOrder = v[1]
             if v[0] == "moveRole": self.moveRole = v[1]
             if v[0] == "moveRoleAmt": self.moveRoleAmt = v[1]
+            if v[0] == "usePool": self.usePool = v[1]
+            if v[0] == "poolSize": self.poolSize = v[1]
+            if v[0] == "queueLimit": self.queueLimit = v[1]
+            if v[0] == "roleGc": self.roleGc = v[1]
+            if v[0] == "roleIdleDays": self.roleIdleDays = v[1]
+            if v[0] == "roleLastRave": self.roleSweeper.lastRave = {role_id: day for role_id, day in v[1]}
+            if v[0] == "labTable" and v[1]: labTable = v[1]
+        # Only a table built for this blacklist by this version of build_lab_table can be used
+        if isinstance(labTable, list) and len(labTable) == 2 and labTable[0] == lab_table_tag(self.blacklist):
+            labTable = base64.b64decode(labTable[1])
+            if len(labTable) == LAB_TABLE_BYTES:
+                store_lab_table(self.blacklist, labTable)
+        self.roleQueue.limit = self.queueLimit
+
+    def saved_lab_table(self):
+        """
+        :return: The lookup table of the blacklist in lab mode as [tag, base64 string], tagged with lab_table_tag so
+            loading the guild can tell whether it may use the table instead of rebuilding it, or None
+        """
+        if self.blacklistMode != "lab":
+            return None
+        table = find_lab_table(self.blacklist)
+        return [lab_table_tag(self.blacklist), base64.b64encode(table).decode()] if table is not None else None
+
+    def compile_admission(self):
+        """
+        Build self.rejection, the check deciding whether a member's message triggers a rave: it returns None if it
+        does, or the reason it doesn't. The settings are read once here rather than on every message, and the
+        checks run cheapest first. Called whenever the settings change.
+
+        :return: None
+        """
+        if not self.enableRave:
+            self.rejection = lambda member: "disabled"
+            return
+
+        cooldowns = self.cooldowns
+        useGlobalCooldown = self.useGlobalCooldown
+        checkOptOut = self.checkOptOut
+        opt_out_set = self.opt_out_set
+        checkRole = self.checkRole
+        requiredRoleId = self.requiredRoleId
+
+        def rejection(member):
+            if cooldowns.active(member.id, useGlobalCooldown):
+                return "cooldown"
+            if checkOptOut and member.id in opt_out_set:
+                return "opt_out"
+            if checkRole and (requiredRoleId is None or not has_role_id(member, requiredRoleId)):
+                return "missing_role"
+            return None
+
+        self.rejection = rejection
+
+    def resolve_required_role(self, server):
+        """
+        Look up the ID of the required role from its name. Called when the required role is set and when roles are
+        created, renamed or deleted, so the admission check only has to compare IDs.
+
+        :param server: The guild
+        :return: None
+        """
+        role = self.get_role(server, self.requiredRole)
+        self.requiredRoleId = role.id if role is not None else None
+        self.compile_admission()
+
+    def apply_config(self, server, change):
+        """
+        Apply a validated ConfigChange all at once: the blacklist ranges are rebuilt once and the variables saved
+        once. Nothing is changed if the result would leave no colors available.
+
+        :param server: The guild
+        :param change: The ConfigChange
+        :return: None
+        :raises ConfigError: if the change can't be applied
+        """
+        previous = {name: getattr(self, name) for name in SETTINGS}
+        previousBlacklist = self.blacklist
+
+        blacklist, problems = self.config_blacklist(change)
+        for name, value in change.settings.items():
+            setattr(self, name, value)
+        self.blacklist = blacklist
+
+        if self.cooldownMin > self.cooldownMax:
+            problems.append("cooldownMin must not be longer than cooldownMax")
+        # Like !required_role, only roles that exist can be required: any other name would reject every message
+        requiredRole = self.get_role(server, self.requiredRole) if "requiredRole" in change.settings else None
+        if "requiredRole" in change.settings and requiredRole is None:
+            problems.append(f"requiredRole: there is no role named {self.requiredRole}")
+        if not problems:
+            self.generate_blacklist_range()
+            if self.colorSampler.total == 0:
+                problems.append("this blacklist would leave no colors available")
+        if problems:
+            for name, value in previous.items():
+                setattr(self, name, value)
+            self.blacklist = previousBlacklist
+            self.generate_blacklist_range()
+            raise ConfigError(problems)
+
+        self.cooldownController.effective = min(max(self.cooldownController.effective, self.cooldownMin), self.cooldownMax)
+        if requiredRole is not None:
+            self.requiredRoleId = requiredRole.id
+        self.save_variables()
+        self.refill_pool(server)
+
+    def refill_pool(self, server):
+        """
+        Start refilling the spare role pool if the guild uses it and it is short of spares
+
+        :param server: The guild
+        :return: None
+        """
+        if self.usePool and not self.useRequiredRole and not self.useBuckets:
+            self.rolePool.replenish(server, self)
+
+    def config_blacklist(self, change):
+        """
+        The blacklist a ConfigChange would leave
+
+        :param change: The ConfigChange
+        :return: (blacklist, list of problems found)
+        """
+        defaultTolerance = change.settings.get("defaultTolerance", self.defaultTolerance)
+        problems = []
+        blacklist = list(change.blacklist if change.blacklist is not None else self.blacklist)
+        for color in change.blacklistRemove:
+            kept = [entry for entry in blacklist if entry[0] != color]
+            if len(kept) == len(blacklist):
+                problems.append(f"{color} is not in the blacklist")
+            blacklist = kept
+        for color, tolerance in change.blacklistAdd:
+            if any(entry[0] == color for entry in blacklist):
+                problems.append(f"{color} is already in the blacklist; remove it first to change its tolerance")
+            blacklist.append([color, tolerance if tolerance is not None else defaultTolerance])
+        return blacklist, problems
+
+    def current_cooldown(self):
+        """
+        :return: The cooldown raves start (seconds): the adaptive one if enabled, cooldownTime otherwise
+        """
+        return self.cooldownController.effective if self.adaptiveCooldown else self.cooldownTime
+
+    def rave_role_position(self, server):
+        """
+        Position rave roles are moved to when moveRole is on
+
+        :param server: The guild
+        :return: The position
+        """
+        if self.moveRoleAmt > 0:
+            return len(server.roles) - self.moveRoleAmt
+        else:
+            return -self.moveRoleAmt
+
+    def get_role(self, server, name):
+        """
+        Find one of the guild's roles by name through the role index
+
+        :param server: The guild
+        :param name: Name of the role
+        :return: The role, or None if there is none with that name
+        """
+        if not self.roleIndex.built:
+            self.roleIndex.rebuild(server.roles)
+        return self.roleIndex.get(name)
 
     def generate_blacklist_range(self):
+        """
+        Rebuild the blacklisted ranges and the sampler of allowed colors from the blacklist
+
+        :return: None
+        """
+        self.blacklist_range = []
         for i in self.blacklist:
             color = i[0]
             tolerance = i[1]
@@ -195,9 +594,128 @@ class Rave:
             g_max = int(color[1] * (1 + tolerance)) if int(color[1] * (1 + tolerance)) <= 255 else 255
             b_max = int(color[2] * (1 + tolerance)) if int(color[2] * (1 + tolerance)) <= 255 else 255
             self.blacklist_range.append(((r_min, g_min, b_min), (r_max, g_max, b_max)))
+        if self.blacklistMode == "lab":
+            self.colorSampler = LabColorSampler(self.blacklist)
+        else:
+            self.colorSampler = ColorSampler(self.blacklist_range)
+        if self.colorMode == "palette":
+            palette = self.paletteColors if self.paletteColors else hue_palette(self.paletteHues)
+            allowed = self.colorSampler
+            self.colorSampler = PaletteSampler([color for color in palette if allowed.allows(color)], self.paletteOrder)
+        self.noColorsLogged = False
+
 
+# Servers list: the loaded Raves, keyed by guild ID
+servers = RaveRegistry(Rave, MAX_RESIDENT_GUILDS, GUILD_IDLE_TTL, can_unload)
 
 
+async def prepare_lab_table(blacklistMode, blacklist):
+    """
+    Build the lookup table of a blacklist in lab mode in an executor thread, so generate_blacklist_range finds it
+    cached instead of building it on the event loop
+
+    :param blacklistMode: The blacklist mode about to be used
+    :param blacklist: The blacklist about to be used
+    :return: None
+    """
+    if blacklistMode == "lab" and find_lab_table(blacklist) is None:
+        await asyncio.get_event_loop().run_in_executor(None, get_lab_table, copy.deepcopy(blacklist))
+
+
+def count_resident_guilds():
+    """
+    Number of loaded Raves per shard, for the metrics
+
+    :return: Dict of (shard label,) -> count
+    """
+    counts = {}
+    for guild_id in servers.entries:
+        key = (metrics.shard_of(guild_id),)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+metrics.RESIDENT_GUILDS.collect = count_resident_guilds
+metrics.GUILD_LOOKUPS.collect = lambda: {
+    (metrics.processShard, "hit"): servers.hits, (metrics.processShard, "miss"): servers.misses
+}
+metrics.GUILD_EVICTIONS.collect = lambda: {(metrics.processShard,): servers.evictions}
+
+
+async def apply_required_role_color(server, rave, colour):
+    """
+    Recolor the required role. Called by the guild's role queue.
+
+    :param server: The guild
+    :param rave: The guild's Rave
+    :param colour: The new colour
+    :return: None
+    """
+    role = rave.roleIndex.get_id(rave.requiredRoleId)
+    if role is not None:
+        await role.edit(colour=colour)
+
+
+async def apply_member_color(server, member, rave, colour):
+    """
+    Recolor a member's rave role, creating (and moving) it first if needed. Called by the guild's role queue.
+
+    :param server: The guild
+    :param member: The member raving
+    :param rave: The guild's Rave
+    :param colour: The new colour
+    :return: None
+    """
+    role = rave.get_role(server, str(member))
+    if role is None and rave.usePool:
+        role = rave.rolePool.take()
+        if role is None:
+            # The pool was just enabled, or filling it failed: refill it for the next first-time ravers
+            rave.rolePool.replenish(server, rave)
+        else:
+            # Spare roles are already in place: renaming and recoloring is a single edit
+            try:
+                await role.edit(name=str(member), colour=colour)
+            except discord.NotFound:
+                raise
+            except Exception:
+                rave.rolePool.put_back(role)
+                raise
+            finally:
+                rave.rolePool.replenish(server, rave)
+            rave.roleIndex.rename(role, str(member))
+            rave.roleSweeper.adopt(role)
+            await member.add_roles(role)
+            track_role_use(rave, role, member)
+            return
+
+    if role is None:
+        role = await server.create_role(name=str(member), colour=colour)
+        rave.roleIndex.add(role)
+        rave.roleSweeper.adopt(role)
+        if rave.moveRole:
+            await server.edit_role_positions(positions={role: rave.rave_role_position(server)})
+    else:
+        await role.edit(colour=colour)
+        # A role named after the member that the bot recolors is their rave role, even one from before role GC
+        rave.roleSweeper.adopt(role)
+    if role not in member.roles:
+        await member.add_roles(role)
+    track_role_use(rave, role, member)
+
+
+def track_role_use(rave, role, member):
+    """
+    Tell the guild's role sweeper a rave role is in use, saving the day it was last used if that changed
+
+    :param rave: The guild's Rave
+    :param role: The member's rave role
+    :param member: The member
+    :return: None
+    """
+    rave.roleSweeper.used(role, member)
+    if rave.roleSweeper.unsaved:
+        rave.save_variables()
 
 
 @bot.event
@@ -209,118 +727,230 @@ async def on_ready():
     """
     print(f'{bot.user} has connected to Discord!')
 
+    if METRICS_PORT is not None:
+        if SHARD_COUNT is not None:
+            shards = cluster_shard_ids(SHARD_COUNT, CLUSTER_COUNT, CLUSTER_ID)
+            shard_label = f"{shards[0]}-{shards[-1]}" if shards else "none"
+        else:
+            shard_label = "0" if bot.shard_count in (None, 1) else f"0-{bot.shard_count - 1}"
+        if not metrics.started:
+            metrics.instrument_http(bot.http)
+        metrics.start(METRICS_HOST, METRICS_PORT, shard_label, bot.shard_count or 1)
+
+    global roleGcTask
+    if ROLE_GC_INTERVAL > 0 and roleGcTask is None:
+        roleGcTask = asyncio.get_event_loop().create_task(sweep_stale_roles())
+
+    global warmStarted
+    if WARM_START and not warmStarted:
+        warmStarted = True
+        await warm_start()
+
+
+warmStarted = False  # Whether warm_start already ran; on_ready also fires after reconnects
+roleGcTask = None  # Task running sweep_stale_roles, started by the first on_ready
+
+
+async def sweep_stale_roles():
+    """
+    Every ROLE_GC_INTERVAL seconds, delete up to ROLE_GC_BATCH stale rave roles in each loaded guild with !role_gc on.
+
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(ROLE_GC_INTERVAL)
+        reclaimed = 0
+        for rave in list(servers):
+            guild = bot.get_guild(rave.guildId)
+            # Skip guilds unloaded while an earlier guild was being swept
+            if not rave.roleGc or guild is None or servers.find(rave.guildId) is not rave:
+                continue
+            try:
+                reclaimed += len(await rave.roleSweeper.sweep(guild, rave, rave.roleIdleDays, ROLE_GC_BATCH))
+            except Exception:
+                traceback.print_exc()
+            if rave.roleSweeper.unsaved:
+                rave.save_variables()
+        if reclaimed:
+            print(f"Role GC: deleted {reclaimed} stale rave roles.")
+
+
+async def warm_start():
+    """
+    Load the state of the bot's guilds before their first message: from the snapshot of the last clean shutdown if
+    there is one, otherwise from storage, with the reads spread over executor threads. Guilds without saved state are
+    left to be loaded on first use.
+
+    :return: None
+    """
+    loop = asyncio.get_event_loop()
+    snapshot = await loop.run_in_executor(None, read_snapshot, SNAPSHOT_PATH)
+    guilds = [guild for guild in bot.guilds if guild.id not in servers][:MAX_RESIDENT_GUILDS]
+
+    missing = [guild for guild in guilds if server_name(guild) not in snapshot]
+    states = await asyncio.gather(
+        *(loop.run_in_executor(None, load_known_state, server_name(guild)) for guild in missing), return_exceptions=True
+    )
+    for guild, state in zip(missing, states):
+        if state is not None and not isinstance(state, Exception):
+            snapshot[server_name(guild)] = state
+
+    loaded = 0
+    for guild in guilds:
+        state = snapshot.get(server_name(guild))
+        if state is None or not any(state) or guild.id in servers:
+            continue
+        try:
+            servers.add(guild.id, Rave(guild, state))
+            loaded += 1
+        except Exception:
+            traceback.print_exc()
+        if loaded % 100 == 0:
+            # Building the Raves is CPU work: let the messages that arrive meanwhile through
+            await asyncio.sleep(0)
+    print(f"Warm start: loaded {loaded} guilds ({len(guilds) - len(missing)} from the snapshot).")
+
 
 @bot.event
-async def on_message(message):
+async def on_guild_available(guild):
     """
-    Does the role rave shenanigans.
+    Rebuilds the role index when a guild (re)appears, since its role objects are new.
 
-    :param message: message
+    :param guild: The guild
     :return: None
     """
+    rave = servers.find(guild.id)
+    if rave is not None:
+        rave.roleIndex.rebuild(guild.roles)
+        rave.resolve_required_role(guild)
+        rave.rolePool.load(guild.roles)
+        rave.bucketRoles.load(guild.roles)
 
-    global servers
-    # global cooldown
-    # global globalCooldown
-    # global enableRave
 
-    member = message.author
-    server = message.guild
-    serverStr = str(message.guild.id)+"."+str(message.guild)
-    rave = check_server(serverStr)
+@bot.event
+async def on_guild_remove(guild):
+    """
+    Unloads the Rave of a guild the bot left. Its unsaved changes are still written by the writer.
 
-    isCommand = False  # Set to true if message is a command
-    isCooldownActive = False  # Set to true if the cooldown is active
-    isOptedOut = False  # Set to true if user opted out (if applicable)
-    isRequiredRole = True  # Set to false if CHECK_BOOSTER_ROLE and if member is not a booster
+    :param guild: The guild
+    :return: None
+    """
+    servers.evict(guild.id)
 
-    # Don't process the bot's own messages
-    if member == bot.user:
-        return
 
-    # Check if the message is a command
-    try:
-        if message.content[0] == '!':
-            isCommand = True
-    except:
-        pass
+@bot.event
+async def on_guild_role_create(role):
+    """
+    Adds a created role to the role index.
 
-    # Check if the cooldown is active
-    if rave.useGlobalCooldown:
-        isCooldownActive = rave.globalCooldown
-    else:
-        if member.id in rave.cooldown:
-            isCooldownActive = True
+    :param role: The role
+    :return: None
+    """
+    rave = servers.find(role.guild.id)
+    if rave is not None and rave.roleIndex.built:
+        rave.roleIndex.add(role)
+        if role.name == rave.requiredRole:
+            rave.resolve_required_role(role.guild)
 
-    # Check for required role
-    if rave.checkRole:
-        isRequiredRole = False
-        for role in member.roles:
-            if role.name == rave.requiredRole:
-                isRequiredRole = True
-                break
 
-    # Check for opt-out status
-    if rave.checkOptOut and member.id in rave.opt_out_list:
-        isOptedOut = True
+@bot.event
+async def on_guild_role_update(before, after):
+    """
+    Updates the role index when a role changes.
 
-    # Process color change
-    if rave.enableRave and isRequiredRole and not isCommand and not isCooldownActive and not isOptedOut:
+    :param before: The role before the update
+    :param after: The role after the update
+    :return: None
+    """
+    rave = servers.find(after.guild.id)
+    if rave is not None and rave.roleIndex.built:
+        rave.roleIndex.update(before, after)
+        if before.name != after.name and rave.requiredRole in (before.name, after.name):
+            rave.resolve_required_role(after.guild)
 
-        # Start the cooldown
-        if rave.useGlobalCooldown:
-            rave.globalCooldown = True
-        else:
-            rave.cooldown.append(member.id)
 
-        # Generate color (hex value stored in integer)
-        unacceptable_color = True
-        while unacceptable_color:
+@bot.event
+async def on_guild_role_delete(role):
+    """
+    Removes a deleted role from the role index.
 
-            color_r = int(random.random() * 256)
-            color_g = int(random.random() * 256)
-            color_b = int(random.random() * 256)
+    :param role: The role
+    :return: None
+    """
+    rave = servers.find(role.guild.id)
+    if rave is not None and rave.roleIndex.built:
+        rave.roleIndex.remove(role)
+        if role.id == rave.requiredRoleId:
+            rave.resolve_required_role(role.guild)
+        rave.rolePool.forget(role)
+        rave.roleSweeper.forget(role.id)
+        rave.bucketRoles.forget(role)
 
-            unacceptable_color = False
 
-            for clr in rave.blacklist_range:
-                if clr[0][0] <= color_r <= clr[1][0] \
-                        and clr[0][1] <= color_g <= clr[1][1] \
-                        and clr[0][2] <= color_b <= clr[1][2]:
-                    unacceptable_color = True
-                    break
+@bot.event
+async def on_message(message):
+    """
+    Does the role rave shenanigans.
 
-        color = color_r * 65536 + color_g * 256 + color_b
+    :param message: message
+    :return: None
+    """
 
-        # Apply color change
-        if rave.useRequiredRole:
-            role = discord.utils.get(server.roles, name=rave.requiredRole)
-            await role.edit(colour=discord.Colour(color))
-        else:
-            rolesNum = len(server.roles)
-            if not discord.utils.get(server.roles, name=str(member)):
-                await server.create_role(name=str(member), colour=discord.Colour(color))
-                role = discord.utils.get(server.roles, name=str(member))
-                if rave.moveRole:
-                    if rave.moveRoleAmt > 0:
-                        await server.edit_role_positions(positions={role: rolesNum-rave.moveRoleAmt})
-                    else:
-                        await server.edit_role_positions(positions={role: -rave.moveRoleAmt})
-            else:
-                role = discord.utils.get(server.roles, name=str(member))
-                await role.edit(colour=discord.Colour(color))
-            await member.add_roles(role)
+    member = message.author
+    server = message.guild
 
-        # Wait the cooldown duration
-        await asyncio.sleep(rave.cooldownTime)
+    # Cheapest checks first: DMs, bots (including this one), then commands, which never rave
+    if server is None or member.bot:
+        return
+    if message.content.startswith('!'):
+        metrics.skipped(server.id, "command")
+        await bot.process_commands(message)
+        return
 
-        if rave.useGlobalCooldown:
-            rave.globalCooldown = False
-        else:
-            rave.cooldown.remove(member.id)
+    # Process color change
+    stopwatch = metrics.stopwatch(server.id)
+    rave = servers.get(server)
+    reason = rave.rejection(member)
+    stopwatch.lap("admission")
+    if reason is not None:
+        metrics.skipped(server.id, reason)
+    else:
 
-    # I had this here for a good reason. I don't remember what that reason is.
-    await bot.process_commands(message)
+        # Start the cooldown
+        if rave.adaptiveCooldown:
+            rave.cooldownController.rave()
+            if rave.cooldownController.update(rave.editBudget, rave.cooldownMin, rave.cooldownMax):
+                rave.save_variables()
+        rave.cooldowns.start(member.id, rave.current_cooldown(), rave.useGlobalCooldown)
+
+        # Generate color (hex value stored in integer). The bucket colors rotate on their own: in bucket mode the
+        # member only changes buckets, so there is no color to pick
+        useBuckets = rave.useBuckets and not rave.useRequiredRole
+        color = None
+        if not useBuckets:
+            try:
+                color = rave.colorSampler.sample(member.id)
+            except NoAllowedColorsError:
+                if not rave.noColorsLogged:
+                    print(f"Blacklist of {rave.server} leaves no colors available, skipping color changes.")
+                    rave.noColorsLogged = True
+        stopwatch.lap("color")
+
+        # Queue the color change; the queue's worker does the API calls
+        if useBuckets:
+            queued = rave.roleQueue.post(member.id, None, lambda colour: rave.bucketRoles.move(server, member, rave))
+        elif color is None:
+            metrics.skipped(server.id, "no_color")
+        elif rave.useRequiredRole:
+            queued = rave.roleQueue.post(rave.requiredRole, discord.Colour(color), lambda colour: apply_required_role_color(server, rave, colour))
+        else:
+            queued = rave.roleQueue.post(member.id, discord.Colour(color), lambda colour: apply_member_color(server, member, rave, colour))
+        if useBuckets or color is not None:
+            if not queued:
+                metrics.skipped(server.id, "shed")
+            elif metrics.enabled:
+                metrics.RAVES.inc(metrics.shard_of(server.id))
+        stopwatch.lap("queue")
 
 
 @bot.command()
@@ -332,19 +962,13 @@ async def opt_out(ctx):
     :return: None
     """
     # global checkOptOut
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     if rave.checkOptOut:
-        if ctx.author.id not in rave.opt_out_list:
-            rave.opt_out_list.append(ctx.author.id)
+        if rave.set_opt_out(ctx.author.id, True):
             await ctx.send(f"Added {ctx.author.name} to the opt-out list!")
         else:
             await ctx.send(f"{ctx.author.name}, you already opted out!")
-
-        opt_out_file = open(f"opt_out_{server}.json", "w")
-        json.dump(rave.opt_out_list, opt_out_file)
-        opt_out_file.close()
     else:
         await ctx.send(f"The opt-out list is currently disabled!")
 
@@ -358,19 +982,13 @@ async def opt_in(ctx):
     :return: None
     """
     # global checkOptOut
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     if rave.checkOptOut:
-        if ctx.author.id in rave.opt_out_list:
-            rave.opt_out_list.remove(ctx.author.id)
+        if rave.set_opt_out(ctx.author.id, False):
             await ctx.send(f"Removed {ctx.author.name} from the opt-out list!")
         else:
             await ctx.send(f"{ctx.author.name}, you're already opted in!")
-
-        opt_out_file = open(f"opt_out_{server}.json", "w")
-        json.dump(rave.opt_out_list, opt_out_file)
-        opt_out_file.close()
     else:
         await ctx.send(f"The opt-out list is currently disabled!")
 
@@ -385,22 +1003,31 @@ async def color(ctx, *args):
     """
     arg = "".join(args[:])
     server = ctx.guild
-    serverStr = str(ctx.guild.id) + "." + str(ctx.guild)
-    rave = check_server(serverStr)
+    rave = servers.get(server)
 
     if rave.useRequiredRole:
-        role = discord.utils.get(server.roles, name=rave.requiredRole)
+        role = rave.get_role(server, rave.requiredRole)
+    elif rave.useBuckets:
+        # Members share the bucket roles: show the color of the bucket the member is in
+        member = server.get_member_named(arg) if arg != '' else ctx.author
+        role = rave.bucketRoles.member_bucket(member) if member is not None else None
     else:
         if arg != '':
-            if len(arg) < 5 or not arg[-5] == '#':
-                roles = server.roles
-                for i in roles:
-                    if i.name.split('#')[0].lower() == arg:
-                        role = i
+            member_name, separator, discriminator = arg.rpartition('#')
+            if not (separator and member_name and discriminator.isdigit()):
+                if not rave.roleIndex.built:
+                    rave.roleIndex.rebuild(server.roles)
+                matches = rave.roleIndex.find_members(arg)
+                if len(matches) > 1:
+                    shown = ", ".join(f"{i.name} ({i.colour})" for i in matches[:10])
+                    more = f" and {len(matches) - 10} more" if len(matches) > 10 else ""
+                    await ctx.send(f"Several users match: {shown}{more}.")
+                    return
+                role = matches[0] if matches else None
             else:
-                role = discord.utils.get(server.roles, name=arg)
+                role = rave.get_role(server, arg)
         else:
-            role = discord.utils.get(server.roles, name=str(ctx.author))
+            role = rave.get_role(server, str(ctx.author))
     try:
         await ctx.send(f"The color is {role.colour}.")
     except:
@@ -418,15 +1045,20 @@ async def cooldown(ctx, arg=None):
     :return: None
     """
     # global cooldownTime
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     if arg is None:
-        await ctx.send(f"The cooldown time is currently {rave.cooldownTime} seconds!")
+        if rave.adaptiveCooldown:
+            await ctx.send(f"The cooldown time is currently {rave.current_cooldown()} seconds (adaptive, between "
+                           f"{rave.cooldownMin} and {rave.cooldownMax} seconds for {rave.editBudget} edits per minute)!")
+        else:
+            await ctx.send(f"The cooldown time is currently {rave.cooldownTime} seconds!")
     else:
         try:
             rave.cooldownTime = int(arg)
             await ctx.send(f"Set the cooldown time to {rave.cooldownTime} seconds!")
+            if rave.adaptiveCooldown:
+                await ctx.send(f"Adaptive cooldowns are on, so the cooldown stays at {rave.current_cooldown()} seconds until they are turned off.")
             rave.save_variables()
         except ValueError:
             await ctx.send(f"Value must be a number. Cooldown time remains at {rave.cooldownTime} seconds!")
@@ -434,6 +1066,41 @@ async def cooldown(ctx, arg=None):
             await ctx.send(f"Unsuccessful. Cooldown time remains at {rave.cooldownTime} seconds!")
 
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def adaptive_cooldown(ctx, arg1=None, arg2=None, arg3=None, arg4=None):
+    """
+    Whether or not to adjust the cooldown to a budget of role edits per minute, within bounds.
+
+    :param arg1: On/True or off/false
+    :param arg2: Shortest cooldown (seconds)
+    :param arg3: Longest cooldown (seconds)
+    :param arg4: Role edits per minute
+    :param ctx: ctx
+    :return: None
+    """
+    rave = servers.get(ctx.guild)
+
+    adaptiveCooldown = process_boolean(arg1, rave.adaptiveCooldown)
+    if arg1 is not None:
+        try:
+            cooldownMin = int(arg2) if arg2 is not None else rave.cooldownMin
+            cooldownMax = int(arg3) if arg3 is not None else rave.cooldownMax
+            editBudget = int(arg4) if arg4 is not None else rave.editBudget
+            if not 0 <= cooldownMin <= cooldownMax or editBudget < 1:
+                raise ValueError
+        except ValueError:
+            await ctx.send("Bounds must be numbers with the shortest no longer than the longest, and the budget at least 1.")
+            return
+        if adaptiveCooldown and not rave.adaptiveCooldown:
+            rave.cooldownController.effective = rave.cooldownTime
+        rave.adaptiveCooldown, rave.cooldownMin, rave.cooldownMax, rave.editBudget = adaptiveCooldown, cooldownMin, cooldownMax, editBudget
+        rave.cooldownController.effective = min(max(rave.cooldownController.effective, cooldownMin), cooldownMax)
+        rave.save_variables()
+    await ctx.send(f"Adaptive cooldown status: {rave.adaptiveCooldown}; bounds: {rave.cooldownMin}-{rave.cooldownMax} "
+                   f"seconds; budget: {rave.editBudget} edits per minute; current cooldown: {rave.current_cooldown()} seconds")
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def global_cooldown(ctx, arg=None):
@@ -445,8 +1112,7 @@ async def global_cooldown(ctx, arg=None):
     :return: None
     """
     # global useGlobalCooldown
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.useGlobalCooldown = process_boolean(arg, rave.useGlobalCooldown)
     if arg is not None:
@@ -465,8 +1131,7 @@ async def require_role(ctx, arg=None):
     :return: None
     """
     # global checkRole
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.checkRole = process_boolean(arg, rave.checkRole)
     if arg is not None:
@@ -485,13 +1150,13 @@ async def required_role(ctx, arg=None):
     :return: None
     """
     server = ctx.guild
-    serverStr = str(ctx.guild.id) + "." + str(ctx.guild)
-    rave = check_server(serverStr)
+    rave = servers.get(server)
 
-    role = discord.utils.get(server.roles, name=arg)
+    role = rave.get_role(server, arg)
     if arg is not None:
         if role is not None:
             rave.requiredRole = str(role)
+            rave.resolve_required_role(server)
             rave.save_variables()
         else:
             await ctx.send(f"Role not found. Required role: {rave.requiredRole}")
@@ -510,8 +1175,7 @@ async def use_required_role(ctx, arg=None):
     :return: None
     """
     # global checkOptOut
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.useRequiredRole = process_boolean(arg, rave.useRequiredRole)
     if arg is not None:
@@ -519,6 +1183,42 @@ async def use_required_role(ctx, arg=None):
     await ctx.send(f"Use required role status: {rave.useRequiredRole}")
 
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def buckets(ctx, arg1=None, arg2=None, arg3=None):
+    """
+    Whether or not to give ravers one of a fixed set of shared color roles instead of a role of their own.
+
+    :param arg1: On/True or off/false
+    :param arg2: Number of bucket roles (between 1 and 25)
+    :param arg3: Seconds between bucket color changes (0: never)
+    :param ctx: ctx
+    :return: None
+    """
+    rave = servers.get(ctx.guild)
+
+    rave.useBuckets = process_boolean(arg1, rave.useBuckets)
+    if arg1 is not None:
+        try:
+            if arg2 is not None:
+                bucketCount = int(arg2)
+                if not 1 <= bucketCount <= 25:
+                    raise ValueError
+                rave.bucketCount = bucketCount
+            if arg3 is not None:
+                bucketRotate = int(arg3)
+                if not 0 <= bucketRotate <= 86400:
+                    raise ValueError
+                rave.bucketRotate = bucketRotate
+        except ValueError:
+            await ctx.send(f"The number of buckets must be between 1 and 25, and the rotation between 0 and 86400 seconds.")
+        rave.save_variables()
+    await ctx.send(
+        f"Bucket status: {rave.useBuckets}; buckets: {rave.bucketCount}; "
+        f"colors change every: {rave.bucketRotate} seconds (0: never)"
+    )
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def move_role(ctx, arg1=None, arg2=None):
@@ -531,8 +1231,7 @@ async def move_role(ctx, arg1=None, arg2=None):
     :return: None
     """
     # global useGlobalCooldown
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.moveRole = process_boolean(arg1, rave.moveRole)
     if arg1 is not None:
@@ -545,6 +1244,114 @@ async def move_role(ctx, arg1=None, arg2=None):
     await ctx.send(f"Move role status: {rave.moveRole}; amount: {rave.moveRoleAmt}")
 
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def role_pool(ctx, arg1=None, arg2=None):
+    """
+    Whether or not to keep spare rave roles ready, so first-time ravers get their color faster.
+
+    :param arg1: On/True or off/false
+    :param arg2: Number of spare roles to keep
+    :param ctx: ctx
+    :return: None
+    """
+    server = ctx.guild
+    rave = servers.get(server)
+
+    rave.usePool = process_boolean(arg1, rave.usePool)
+    if arg1 is not None:
+        if arg2 is not None:
+            try:
+                poolSize = int(arg2)
+                if not 1 <= poolSize <= 25:
+                    raise ValueError
+                rave.poolSize = poolSize
+            except ValueError:
+                await ctx.send(f"Pool size must be a number between 1 and 25.")
+        rave.save_variables()
+        rave.refill_pool(server)
+    await ctx.send(f"Role pool status: {rave.usePool}; size: {rave.poolSize}; spare roles ready: {len(rave.rolePool.spares)}")
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def role_gc(ctx, arg1=None, arg2=None):
+    """
+    Whether or not to delete stale rave roles in the background, list them (dry), or delete them right away (now)
+
+    :param arg1: On/True, off/false, dry or now
+    :param arg2: Days without a rave after which a rave role is stale (0: never)
+    :param ctx: ctx
+    :return: None
+    """
+    server = ctx.guild
+    rave = servers.get(server)
+    operation = arg1.lower() if arg1 is not None else None
+
+    if operation in ("dry", "now"):
+        if operation == "dry":
+            stale = rave.roleSweeper.find_stale(server, rave, rave.roleIdleDays)
+        else:
+            stale = await rave.roleSweeper.sweep(server, rave, rave.roleIdleDays)
+        if rave.roleSweeper.unsaved:
+            rave.save_variables()
+
+        reasons = {"renamed": "member renamed", "left": "member left", "idle": f"unused for {rave.roleIdleDays}+ days"}
+        counts = ", ".join(
+            f"{sum(1 for role, reason in stale if reason == key)} {label}" for key, label in reasons.items()
+        )
+        names = ", ".join(role.name for role, reason in stale[:20]) + (", ..." if len(stale) > 20 else "")
+        verb = "would be deleted" if operation == "dry" else "deleted"
+        await ctx.send(f"{len(stale)} stale rave roles {verb} ({counts}){': ' + names if stale else '.'}")
+        return
+
+    rave.roleGc = process_boolean(arg1, rave.roleGc)
+    if arg1 is not None:
+        if arg2 is not None:
+            try:
+                roleIdleDays = int(arg2)
+                if not 0 <= roleIdleDays <= 3650:
+                    raise ValueError
+                rave.roleIdleDays = roleIdleDays
+            except ValueError:
+                await ctx.send(f"Idle days must be a number between 0 and 3650.")
+        rave.save_variables()
+    await ctx.send(
+        f"Role GC status: {rave.roleGc}; idle after: {rave.roleIdleDays} days (0: never); "
+        f"roles deleted since loaded: {rave.roleSweeper.reclaimed}"
+    )
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def queue_limit(ctx, arg=None):
+    """
+    Change how many color changes can wait for the API before new ones are dropped, and show the queue's state
+
+    :param arg: Integer for the limit (between 1 and 1000)
+    :param ctx: ctx
+    :return: None
+    """
+    rave = servers.get(ctx.guild)
+
+    if arg is not None:
+        try:
+            limit = int(arg)
+            if not 1 <= limit <= 1000:
+                raise ValueError
+            rave.queueLimit = limit
+            rave.save_variables()
+        except ValueError:
+            await ctx.send(f"Value must be a number between 1 and 1000. Queue limit remains at {rave.queueLimit}.")
+            return
+    stats = rave.roleQueue.stats()
+    await ctx.send(
+        f"Queue limit: {rave.queueLimit}; waiting: {stats['depth']}; dropped: {stats['shed']}; "
+        f"merged: {stats['coalesced']}; sent: {stats['sent']}. "
+        f"All servers: {pendingBudget.used} waiting out of {pendingBudget.limit}."
+    )
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def enable_opt_out(ctx, arg=None):
@@ -556,8 +1363,7 @@ async def enable_opt_out(ctx, arg=None):
     :return: None
     """
     # global checkOptOut
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.checkOptOut = process_boolean(arg, rave.checkOptOut)
     if arg is not None:
@@ -576,8 +1382,7 @@ async def enable_rave(ctx, arg=None):
     :return: None
     """
     # global enableRave
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     rave.enableRave = process_boolean(arg, rave.enableRave)
     if arg is not None:
@@ -596,14 +1401,31 @@ async def blacklist(ctx, operation=None, arg1=None, arg2=None):
     """
 
     server = ctx.guild
-    serverStr = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(serverStr)
+    rave = servers.get(server)
+
+    if operation is not None and operation.lower() == "mode":
+        if arg1 is not None:
+            mode = arg1.lower()
+            if mode != "box" and mode != "lab":
+                await ctx.send("Mode must be either `box` or `lab`.")
+                return
+            previous = rave.blacklistMode
+            await prepare_lab_table(mode, rave.blacklist)
+            rave.blacklistMode = mode
+            rave.generate_blacklist_range()
+            if rave.colorSampler.total == 0:
+                rave.blacklistMode = previous
+                rave.generate_blacklist_range()
+                await ctx.send("This mode would leave no colors available, so it was not changed.")
+                return
+            rave.save_variables()
+        await ctx.send(f"Blacklist mode: {rave.blacklistMode}")
 
-    if operation is not None:
+    elif operation is not None:
         try:
             operation = operation.lower()
             if operation != "add" and operation != "remove":
-                await ctx.send("Operation must be either `add` or `remove`.")
+                await ctx.send("Operation must be either `add`, `remove` or `mode`.")
                 raise Exception
 
             if arg2 is None:
@@ -617,7 +1439,7 @@ async def blacklist(ctx, operation=None, arg1=None, arg2=None):
                     await ctx.send("Tolerance must be a number, and it must be between 0.01 and 0.99.")
                     raise Exception
 
-            role = discord.utils.get(server.roles, name=arg1)
+            role = rave.get_role(server, arg1)
             if role is not None:
                 colors = [(role.colour.r, role.colour.g, role.colour.b), tolerance]
             else:
@@ -635,10 +1457,17 @@ async def blacklist(ctx, operation=None, arg1=None, arg2=None):
                     if r[0] == colors[0]:
                         await ctx.send("Color already exists in blacklist set... If you wish to update the tolerance, remove it first, then re-add it.")
                         raise Exception
+                await prepare_lab_table(rave.blacklistMode, rave.blacklist + [colors])
                 rave.blacklist.append(colors)
                 rave.generate_blacklist_range()
+                if rave.colorSampler.total == 0:
+                    rave.blacklist.remove(colors)
+                    rave.generate_blacklist_range()
+                    await ctx.send("This color would leave no colors available, so it was not added.")
+                    raise Exception
 
             elif operation == "remove":
+                await prepare_lab_table(rave.blacklistMode, [r for r in rave.blacklist if r[0] != colors[0]])
                 removed = False
                 for r in rave.blacklist:
                     if r[0] == colors[0]:
@@ -647,6 +1476,7 @@ async def blacklist(ctx, operation=None, arg1=None, arg2=None):
                 if not removed:
                     await ctx.send("Could not find color to remove.")
                     raise Exception
+                rave.generate_blacklist_range()
 
             rave.save_variables()
             await ctx.send(f"Blacklisted colours (R,G,B,Tolerance): {rave.blacklist}")
@@ -658,6 +1488,56 @@ async def blacklist(ctx, operation=None, arg1=None, arg2=None):
     else:
         await ctx.send(f"Blacklisted colours (R,G,B,Tolerance): {rave.blacklist}")
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def palette(ctx, operation=None, *args):
+    """
+    Display the color mode, or switch to a palette of evenly spaced hues or of given colors.
+
+    :param operation: `off` for random colors, `hues` followed by a number of hues, `colors` followed by hex colors,
+        or `order` followed by `cycle` or `shuffle`
+    :param ctx: ctx
+    :return: None
+    """
+    rave = servers.get(ctx.guild)
+    previous = (rave.colorMode, rave.paletteHues, rave.paletteColors, rave.paletteOrder)
+
+    if operation is not None:
+        try:
+            operation = operation.lower()
+            if operation == "off":
+                rave.colorMode = "random"
+            elif operation == "hues":
+                rave.paletteHues = SETTINGS["paletteHues"](args[0] if args else "")
+                rave.paletteColors = []
+                rave.colorMode = "palette"
+            elif operation == "colors":
+                rave.paletteColors = SETTINGS["paletteColors"](",".join(args))
+                rave.colorMode = "palette"
+            elif operation == "order":
+                rave.paletteOrder = SETTINGS["paletteOrder"](args[0] if args else "")
+            else:
+                raise ValueError("must be `off`, `hues`, `colors` or `order`")
+        except ValueError as e:
+            await ctx.send(f"Unsuccessful: {e}.\nUsage: `!palette [off | hues <count> | colors <#RRGGBB...> | order <cycle or shuffle>]`")
+            return
+
+        await prepare_lab_table(rave.blacklistMode, rave.blacklist)
+        rave.generate_blacklist_range()
+        if rave.colorSampler.total == 0:
+            rave.colorMode, rave.paletteHues, rave.paletteColors, rave.paletteOrder = previous
+            rave.generate_blacklist_range()
+            await ctx.send("The blacklist covers every color of this palette, so it was not changed.")
+            return
+        rave.save_variables()
+
+    if rave.colorMode != "palette":
+        await ctx.send("Color mode: random")
+    else:
+        colors = " ".join(f"#{color:06x}" for color in rave.colorSampler.colors[:50])
+        await ctx.send(f"Color mode: palette ({rave.colorSampler.total} colors, {rave.paletteOrder} order): {colors}")
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def default_blacklist_tolerance(ctx, arg=None):
@@ -669,8 +1549,7 @@ async def default_blacklist_tolerance(ctx, arg=None):
     :return: None
     """
     # global cooldownTime
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     if arg is None:
         await ctx.send(f"The default blacklist tolerance is currently {rave.defaultTolerance}.")
@@ -688,6 +1567,66 @@ async def default_blacklist_tolerance(ctx, arg=None):
         except:
             await ctx.send(f"Unsuccessful. Default blacklist tolerance time remains at {rave.defaultTolerance}.")
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def config(ctx, operation=None, *args):
+    """
+    Show, change, export or import the guild's whole configuration.
+
+    :param operation: `set` followed by key=value, blacklist+=R,G,B[:tolerance] and blacklist-=R,G,B arguments,
+        `export`, or `import` followed by the exported JSON (or with it attached as a file)
+    :param ctx: ctx
+    :return: None
+    """
+    server = ctx.guild
+    rave = servers.get(server)
+
+    try:
+        if operation is None:
+            settings = "\n".join(f"{name}={getattr(rave, name)}" for name in SETTINGS)
+            settings += f"\nblacklist={rave.blacklist}"
+            # A long blacklist or palette doesn't fit in a message
+            if len(settings) > 1900:
+                await ctx.send(file=discord.File(io.BytesIO(settings.encode()), filename=f"rolerave_{server.id}.txt"))
+            else:
+                await ctx.send(f"```\n{settings}\n```")
+            return
+        operation = operation.lower()
+
+        if operation == "set":
+            if not args:
+                raise ConfigError(["Nothing to change"])
+            change = parse_changes(args)
+            await prepare_lab_table(change.settings.get("blacklistMode", rave.blacklistMode), rave.config_blacklist(change)[0])
+            rave.apply_config(server, change)
+            await ctx.send(f"Applied {len(args)} change(s).")
+
+        elif operation == "export":
+            exported = export_config(rave)
+            if len(exported) > 1900:
+                await ctx.send(file=discord.File(io.BytesIO(exported.encode()), filename=f"rolerave_{server.id}.json"))
+            else:
+                await ctx.send(f"```json\n{exported}\n```")
+
+        elif operation == "import":
+            if ctx.message.attachments:
+                text = (await ctx.message.attachments[0].read()).decode()
+            else:
+                # Taken from the raw message, since the argument parser would eat the JSON's quotes
+                parts = ctx.message.content.split(None, 2)
+                text = parts[2] if len(parts) > 2 else ""
+            change = parse_import(text)
+            await prepare_lab_table(change.settings.get("blacklistMode", rave.blacklistMode), rave.config_blacklist(change)[0])
+            rave.apply_config(server, change)
+            await ctx.send("Imported the configuration.")
+
+        else:
+            await ctx.send("Usage: `!config [set <key=value...> | export | import <JSON>]`")
+
+    except ConfigError as e:
+        await ctx.send("Nothing was changed:\n" + "\n".join(f"- {problem}" for problem in e.problems))
+
+
 @bot.command()
 async def help(ctx):
     """
@@ -696,16 +1635,10 @@ async def help(ctx):
     :param ctx: ctx
     :return: None
     """
-    server = str(ctx.guild.id)+"."+str(ctx.guild)
-    rave = check_server(server)
+    rave = servers.get(ctx.guild)
 
     isAdmin = ctx.author.guild_permissions.administrator
-    isRequiredRole = not rave.checkRole
-
-    for r in ctx.author.roles:
-        if rave.requiredRole in r.name:
-            isRequiredRole = True
-            break
+    isRequiredRole = not rave.checkRole or (rave.requiredRoleId is not None and has_role_id(ctx.author, rave.requiredRoleId))
 
     embed = discord.Embed(
         colour=discord.Colour.magenta()
@@ -741,6 +1674,11 @@ async def help(ctx):
             value="Change the cooldown duration.",
             inline=False
         )
+        embed.add_field(
+            name="!adaptive_cooldown [on/true or off/false] [shortest] [longest] [edits per minute]",
+            value="Whether or not to adjust the cooldown automatically, between the shortest and longest durations, to keep role edits under a budget per minute (and back off when Discord rate-limits them).",
+            inline=False
+        )
         embed.add_field(
             name="!global_cooldown [on/true or off/false]",
             value="Display the global cooldown status; set it to on (true) or off (false) if a valid arg is passed.",
@@ -761,6 +1699,27 @@ async def help(ctx):
             value="Whether or not to move the rolerave roles, and by how much (if on).",
             inline=False
         )
+        embed.add_field(
+            name="!buckets [on/true or off/false] [count] [seconds]",
+            value="Whether or not to move ravers between [count] shared color roles, whose colors change every [seconds] seconds, instead of giving each raver a role of their own (the required role setting still comes first).",
+            inline=False
+        )
+        embed.add_field(
+            name="!role_pool [on/true or off/false] [size]",
+            value="Whether or not to keep spare rave roles ready for first-time ravers, and how many (if on).",
+            inline=False
+        )
+        embed.add_field(
+            name="!role_gc [on/true or off/false] [idle days] | !role_gc [dry or now]",
+            value="Whether or not to delete stale rave roles (of members who left or renamed, or unused for [idle days] days) in the background. \
+            `dry` lists the roles that would be deleted, `now` deletes them right away.",
+            inline=False
+        )
+        embed.add_field(
+            name="!queue_limit [limit]",
+            value="Display the color change queue, or change how many color changes can wait before new ones are dropped.",
+            inline=False
+        )
         embed.add_field(
             name="!enable_opt_out [on/true or off/false]",
             value="Display the opt-out ability status; set it to on (true) or off (false) if a valid arg is passed.",
@@ -779,16 +1738,40 @@ async def help(ctx):
             [Tolerance]: The tolerance for a given role color. Must be between 0.01 and 0.99.",
             inline=False
         )
+        embed.add_field(
+            name="!blacklist mode [box or lab]",
+            value="How blacklisted colors are matched: `box` allows each of R, G and B to differ by the tolerance, \
+            `lab` uses perceptual (CIELAB) distance, with a tolerance of 0.2 covering colors within a distance of 20.",
+            inline=False
+        )
+        embed.add_field(
+            name="!palette [off | hues <count> | colors <#RRGGBB...> | order <cycle or shuffle>]",
+            value="Display the color mode, or pick colors from a fixed palette instead of at random: \n\
+            `hues` uses that many evenly spaced hues, `colors` uses the given colors, `off` goes back to random colors, \n\
+            `order` hands the palette out in turn (`cycle`) or at random without repeating a member's color (`shuffle`). \n\
+            Palette colors covered by the blacklist are left out.",
+            inline=False
+        )
         embed.add_field(
             name="!default_blacklist_tolerance [tolerance]",
             value="Change the default blacklist tolerance.",
             inline=False
         )
+        embed.add_field(
+            name="!config [set <key=value...> | export | import <JSON>]",
+            value="Display the whole configuration, or change several settings at once: \n\
+            `set` applies every `key=value` (e.g. `cooldownTime=10 moveRole=on`), `blacklist+=R,G,B[:Tolerance]` and \
+            `blacklist-=R,G,B` argument together, or none of them if one is invalid, \n\
+            `export` gives the configuration as JSON, which `import` (with the JSON or a file attached) restores.",
+            inline=False
+        )
 
     embed.add_field(name="!help", value="Displays this help message", inline=False)
 
     await ctx.send(embed=embed)
 
 
-# print(TOKEN)
-bot.run(TOKEN)
+if __name__ == "__main__":
+    # print(TOKEN)
+    bot.run(TOKEN)
+
@@ -0,0 +1,278 @@
+"""
+Opt-in metrics, served over a local HTTP port in the Prometheus text format. Every metric is labelled with the shard
+it belongs to; process-wide metrics use the range of shards the process connects (processShard).
+"""
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+
+enabled = False  # Set by start(); stopwatches do nothing until then
+processShard = "0"  # Shard label of process-wide metrics
+shardCount = 1  # Total number of shards, to work out a guild's shard
+started = False
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=("shard",), collect=None):
+        """
+        :param collect: Function returning {label values: value}, called when the metrics are scraped, for values
+            counted elsewhere
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # Label values -> count
+        self.collect = collect
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram:
+    kind = "histogram"
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, name, help, labels=("shard",), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # Label values -> [per-bucket counts (last one is +Inf), sum]
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in self.values.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield self.name + "_bucket", dict(labels, le=le), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+MESSAGE_STAGE_SECONDS = Histogram(
+    "rolerave_message_stage_seconds", "Time spent in each stage of on_message", ("shard", "stage")
+)
+RAVES = Counter("rolerave_raves_total", "Messages that triggered a color change")
+RAVES_SKIPPED = Counter("rolerave_raves_skipped_total", "Messages that did not trigger a color change", ("shard", "reason"))
+API_CALLS = Counter("rolerave_api_calls_total", "Discord API requests", ("shard", "method", "route"))
+API_RATE_LIMITED = Counter("rolerave_api_rate_limited_total", "Discord API requests answered with a 429", ("shard", "route"))
+STORAGE_WRITE_SECONDS = Histogram("rolerave_storage_write_seconds", "Time taken by each storage write")
+RESIDENT_GUILDS = Gauge("rolerave_resident_guilds", "Guilds whose Rave is loaded")
+GUILD_LOOKUPS = Counter(
+    "rolerave_guild_lookups_total", "Lookups of a guild's Rave, by whether it was loaded already", ("shard", "result")
+)
+GUILD_EVICTIONS = Counter("rolerave_guild_evictions_total", "Raves unloaded to stay under the limit or when idle")
+LOOP_LAG_SECONDS = Histogram("rolerave_event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback")
+
+METRICS = [
+    MESSAGE_STAGE_SECONDS, RAVES, RAVES_SKIPPED, API_CALLS, API_RATE_LIMITED, STORAGE_WRITE_SECONDS,
+    RESIDENT_GUILDS, GUILD_LOOKUPS, GUILD_EVICTIONS, LOOP_LAG_SECONDS
+]
+
+
+def shard_of(guild_id):
+    """
+    :param guild_id: ID of a guild, or None
+    :return: Shard label of the guild (the process's label if there is no guild)
+    """
+    if guild_id is None:
+        return processShard
+    return str((int(guild_id) >> 22) % shardCount)
+
+
+class Stopwatch:
+    def __init__(self, shard):
+        """
+        Times consecutive stages of a message into MESSAGE_STAGE_SECONDS.
+
+        :param shard: Shard label
+        """
+        self.shard = shard
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        Record the time since the previous lap (or the start) as stage
+
+        :param stage: Name of the stage that just ended
+        :return: None
+        """
+        now = time.perf_counter()
+        MESSAGE_STAGE_SECONDS.observe(now - self.last, self.shard, stage)
+        self.last = now
+
+
+class NullStopwatch:
+    def lap(self, stage):
+        pass
+
+
+NULL_STOPWATCH = NullStopwatch()
+
+
+def stopwatch(guild_id):
+    """
+    :param guild_id: ID of the guild the message comes from
+    :return: A Stopwatch, or one that does nothing when metrics are disabled
+    """
+    return Stopwatch(shard_of(guild_id)) if enabled else NULL_STOPWATCH
+
+
+def skipped(guild_id, reason):
+    """
+    Count a message that did not trigger a color change
+
+    :param guild_id: ID of the guild the message comes from
+    :param reason: Why (e.g. cooldown, opt_out, missing_role, command)
+    :return: None
+    """
+    if enabled:
+        RAVES_SKIPPED.inc(shard_of(guild_id), reason)
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def instrument_http(http):
+    """
+    Count the requests made through a discord.py HTTPClient, by route and shard. 429s that discord.py retries by
+    itself are only logged, so they are counted from its log records. That includes the last one, which it raises
+    after running out of retries; only the 429s it raises without logging (the Cloudflare ones, which have no Via
+    header) are counted here.
+
+    :param http: The bot's HTTPClient
+    :return: None
+    """
+    request = http.request
+
+    async def counted_request(route, **kwargs):
+        shard = shard_of(getattr(route, "guild_id", None))
+        API_CALLS.inc(shard, route.method, route.path)
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            if getattr(e, "status", None) == 429 and not e.response.headers.get("Via"):
+                API_RATE_LIMITED.inc(shard, route.path)
+            raise
+
+    http.request = counted_request
+    logging.getLogger("discord.http").addHandler(RateLimitLogHandler(count_rate_limit))
+
+
+def count_rate_limit(retry_after, guild_id, path):
+    """
+    Count a 429 logged by discord.http
+
+    :param retry_after: Seconds Discord asked to wait
+    :param guild_id: ID of the guild of the request, or None
+    :param path: Route path of the request
+    :return: None
+    """
+    API_RATE_LIMITED.inc(shard_of(guild_id), path)
+
+
+class RateLimitLogHandler(logging.Handler):
+    def __init__(self, callback):
+        """
+        Passes on the "We are being rate limited" warnings of discord.http, which are all that is seen of the 429s
+        discord.py retries by itself. Their bucket argument looks like "<channel id>:<guild id>:<route path>".
+
+        :param callback: Function called with the retry-after (seconds), the guild ID (None if the request had no
+            guild) and the route path ("unknown" if the warning couldn't be parsed)
+        """
+        super().__init__(logging.WARNING)
+        self.callback = callback
+
+    def emit(self, record):
+        if not str(record.msg).startswith("We are being rate limited"):
+            return
+        try:
+            channel_id, guild_id, path = str(record.args[1]).split(":", 2)
+            retry_after = float(record.args[0])
+        except (IndexError, TypeError, ValueError):
+            self.callback(0.0, None, "unknown")
+            return
+        self.callback(retry_after, int(guild_id) if guild_id.isdigit() else None, path)
+
+
+async def monitor_loop_lag(interval=1.0):
+    """
+    Measure how late the event loop runs a sleep, forever
+
+    :param interval: Seconds between measurements
+    :return: None
+    """
+    while True:
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(time.perf_counter() - before - interval, 0.0), processShard)
+
+
+async def handle_scrape(reader, writer):
+    try:
+        await reader.readline()
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def start(host, port, shard_label, shard_count):
+    """
+    Enable the metrics and start serving them. Only the first call does anything.
+
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param shard_label: Shard label of process-wide metrics
+    :param shard_count: Total number of shards
+    :return: None
+    """
+    global enabled, processShard, shardCount, started
+    if started:
+        return
+    started = enabled = True
+    processShard = shard_label
+    shardCount = shard_count
+    loop = asyncio.get_event_loop()
+    loop.create_task(asyncio.start_server(handle_scrape, host, port))
+    loop.create_task(monitor_loop_lag())
@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import traceback
+import metrics
+
+
+def write_file_atomic(filename, text):
+    """
+    Writes text to a temporary file, syncs it to disk, then renames it over filename, so a crash mid-write never
+    leaves a truncated file behind.
+
+    :param filename: Name of the file (with extension) to write
+    :param text: Contents of the file
+    :return: None
+    """
+    temp_name = filename + ".tmp"
+    with open(temp_name, "w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_name, filename)
+
+
+class WriteBehind:
+    def __init__(self, delay=2.0):
+        """
+        Debounced write-behind. Callers mark a piece of state dirty and return immediately; a background task waits
+        for the debounce window, then writes everything that is dirty from an executor thread. Marking the same key
+        dirty again before it is written costs nothing more.
+
+        :param delay: Debounce window (seconds)
+        """
+        self.delay = delay
+        self.dirty = {}  # Key -> (function returning the data, function writing it)
+        self.task = None  # Task waiting for the debounce window, None while idle
+        self.writing = set()  # Keys of the batch being written
+        self.lock = asyncio.Lock()  # Keeps flushes in order so an older snapshot never overwrites a newer one
+
+    def mark_dirty(self, key, produce, write):
+        """
+        Schedule a write.
+
+        :param key: What is being written (e.g. a filename); one write per key is kept
+        :param produce: Function returning the data to write. It is called on the event loop at flush time, so the
+            latest state is written, and must return data that is safe to hand to another thread (e.g. a copy).
+        :param write: Function called with the data from an executor thread
+        :return: None
+        """
+        self.dirty[key] = (produce, write)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def is_pending(self, key):
+        """
+        Check whether a key has changes that haven't reached storage yet
+
+        :param key: Key passed to mark_dirty
+        :return: True if the key is dirty or being written
+        """
+        return key in self.dirty or key in self.writing
+
+    async def run(self):
+        """
+        Wait for the debounce window, then flush.
+
+        :return: None
+        """
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Write everything that is dirty now. Also called at shutdown.
+
+        :return: None
+        """
+        async with self.lock:
+            while self.dirty:
+                batch, self.dirty = self.dirty, {}
+                self.writing = set(batch)
+
+                # Snapshot on the event loop so the data can't change mid-write, then write from a thread
+                jobs = []
+                for produce, write in batch.values():
+                    try:
+                        jobs.append((write, produce()))
+                    except Exception:
+                        traceback.print_exc()
+                try:
+                    durations = await asyncio.get_event_loop().run_in_executor(None, self.write_all, jobs)
+                    if metrics.enabled:
+                        for duration in durations:
+                            metrics.STORAGE_WRITE_SECONDS.observe(duration, metrics.processShard)
+                finally:
+                    self.writing = set()
+
+    @staticmethod
+    def write_all(jobs):
+        """
+        Perform a batch of writes. Runs in an executor thread.
+
+        :param jobs: List of (write, data)
+        :return: List of the time taken by each write (seconds)
+        """
+        durations = []
+        for write, data in jobs:
+            start = time.perf_counter()
+            try:
+                write(data)
+            except Exception:
+                traceback.print_exc()
+            durations.append(time.perf_counter() - start)
+        return durations
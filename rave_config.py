@@ -0,0 +1,248 @@
+"""
+Validation of batched guild configuration changes (!config set) and of whole-config JSON imports (!config import).
+Nothing here touches a Rave: the parsed changes are applied by Rave.apply_config in a single step.
+"""
+import json
+
+
+class ConfigError(Exception):
+    """
+    Raised with every problem found in a configuration change, so they can all be reported at once
+    """
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def parse_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("on", "true"):
+        return True
+    if isinstance(value, str) and value.lower() in ("off", "false"):
+        return False
+    raise ValueError("must be on/true or off/false")
+
+
+def parse_int(low=None, high=None):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError("must be a whole number")
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError("must be a whole number")
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError(f"must be between {low} and {high}" if high is not None else f"must be at least {low}")
+        return value
+    return parse
+
+
+def parse_tolerance(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("must be a number")
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError("must be a number")
+    if not 0.01 <= value <= 0.99:
+        raise ValueError("must be between 0.01 and 0.99")
+    return value
+
+
+def parse_role_name(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("must be a role name")
+    return value.strip()
+
+
+def parse_choice(*choices):
+    def parse(value):
+        if not isinstance(value, str) or value.lower() not in choices:
+            raise ValueError(f"must be {' or '.join(choices)}")
+        return value.lower()
+    return parse
+
+
+def parse_palette_colors(value):
+    """
+    :param value: Comma-separated "#RRGGBB" string, or list of "#RRGGBB" strings and integers
+    :return: List of the colors' hex values stored in integers
+    """
+    if isinstance(value, str):
+        value = [color for color in value.replace(' ', '').split(',') if color]
+    if not isinstance(value, list):
+        raise ValueError("must be a list of #RRGGBB colors")
+    colors = []
+    for color in value:
+        if isinstance(color, str):
+            try:
+                color = int(color.lstrip('#'), 16)
+            except ValueError:
+                raise ValueError(f"has an invalid color {color}; colors must look like #RRGGBB")
+        if isinstance(color, bool) or not isinstance(color, int) or not 0 <= color <= 0xFFFFFF:
+            raise ValueError(f"has an invalid color {color}; colors must look like #RRGGBB")
+        colors.append(color)
+    if len(colors) > 1000:
+        raise ValueError("can have at most 1000 colors")
+    return colors
+
+
+# Settings that can be changed with !config, by Rave attribute name, with the function validating their values
+SETTINGS = {
+    "useGlobalCooldown": parse_boolean,
+    "cooldownTime": parse_int(0),
+    "adaptiveCooldown": parse_boolean,
+    "cooldownMin": parse_int(0),
+    "cooldownMax": parse_int(0),
+    "editBudget": parse_int(1),
+    "checkRole": parse_boolean,
+    "requiredRole": parse_role_name,
+    "useRequiredRole": parse_boolean,
+    "useBuckets": parse_boolean,
+    "bucketCount": parse_int(1, 25),
+    "bucketRotate": parse_int(0, 86400),
+    "checkOptOut": parse_boolean,
+    "enableRave": parse_boolean,
+    "moveRole": parse_boolean,
+    "moveRoleAmt": parse_int(),
+    "usePool": parse_boolean,
+    "poolSize": parse_int(1, 25),
+    "queueLimit": parse_int(1, 1000),
+    "roleGc": parse_boolean,
+    "roleIdleDays": parse_int(0, 3650),
+    "defaultTolerance": parse_tolerance,
+    "blacklistMode": parse_choice("box", "lab"),
+    "colorMode": parse_choice("random", "palette"),
+    "paletteHues": parse_int(1, 360),
+    "paletteColors": parse_palette_colors,
+    "paletteOrder": parse_choice("cycle", "shuffle"),
+}
+SETTING_NAMES = {name.lower(): name for name in SETTINGS}  # Keys are matched regardless of case
+
+
+def parse_color(value):
+    """
+    :param value: "R,G,B" string (parentheses and spaces allowed) or [r, g, b] list
+    :return: (r, g, b) tuple
+    """
+    if isinstance(value, str):
+        value = value.replace('(', '').replace(')', '').replace(' ', '').split(',')
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise ValueError("must be R,G,B")
+    try:
+        color = tuple(int(channel) for channel in value)
+    except (TypeError, ValueError):
+        raise ValueError("must be R,G,B")
+    if not all(0 <= channel <= 255 for channel in color):
+        raise ValueError("channels must be between 0 and 255")
+    return color
+
+
+class ConfigChange:
+    def __init__(self):
+        """
+        A validated set of changes to a guild's configuration.
+        """
+        self.settings = {}  # Rave attribute -> new value
+        self.blacklist = None  # Replacement blacklist, or None to keep the current one
+        self.blacklistAdd = []  # [(r, g, b), tolerance] entries to add (tolerance None: the default tolerance)
+        self.blacklistRemove = []  # (r, g, b) colors to remove
+
+
+def parse_changes(tokens):
+    """
+    Validate the arguments of !config set: key=value settings, blacklist+=R,G,B[:tolerance] and blacklist-=R,G,B
+
+    :param tokens: The arguments
+    :return: ConfigChange
+    :raises ConfigError: listing every invalid argument
+    """
+    change = ConfigChange()
+    problems = []
+    for token in tokens:
+        try:
+            if token.lower().startswith("blacklist+="):
+                color, _, tolerance = token[len("blacklist+="):].partition(':')
+                entry = [parse_color(color), parse_tolerance(tolerance) if tolerance else None]
+                if entry[0] in (added[0] for added in change.blacklistAdd):
+                    raise ValueError("is listed twice")
+                change.blacklistAdd.append(entry)
+            elif token.lower().startswith("blacklist-="):
+                change.blacklistRemove.append(parse_color(token[len("blacklist-="):]))
+            else:
+                key, separator, value = token.partition('=')
+                if not separator:
+                    raise ValueError("must look like key=value")
+                name = SETTING_NAMES.get(key.lower())
+                if name is None:
+                    raise ValueError("is not a setting")
+                change.settings[name] = SETTINGS[name](value)
+        except ValueError as e:
+            problems.append(f"`{token}` {e}")
+    if problems:
+        raise ConfigError(problems)
+    return change
+
+
+def export_config(rave):
+    """
+    :param rave: A guild's Rave
+    :return: The guild's configuration as a JSON string
+    """
+    config = {name: getattr(rave, name) for name in SETTINGS}
+    config["blacklist"] = [[list(color), tolerance] for color, tolerance in rave.blacklist]
+    return json.dumps(config, indent=2)
+
+
+def parse_import(text):
+    """
+    Validate a configuration exported by export_config. Settings it leaves out keep their current value.
+
+    :param text: The JSON string, optionally wrapped in a ``` code block
+    :return: ConfigChange replacing the blacklist if the JSON has one
+    :raises ConfigError: listing every problem found
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip('`')
+        if text.startswith("json"):
+            text = text[len("json"):]
+    try:
+        config = json.loads(text)
+    except ValueError as e:
+        raise ConfigError([f"Invalid JSON: {e}"])
+    if not isinstance(config, dict):
+        raise ConfigError(["The configuration must be a JSON object"])
+
+    change = ConfigChange()
+    problems = []
+    for key, value in config.items():
+        if key == "blacklist":
+            if not isinstance(value, list):
+                problems.append("`blacklist` must be a list of [[R, G, B], tolerance]")
+                continue
+            change.blacklist = []
+            for entry in value:
+                try:
+                    if not isinstance(entry, list) or len(entry) != 2:
+                        raise ValueError("must be [[R, G, B], tolerance]")
+                    color = parse_color(entry[0])
+                    if color in (listed[0] for listed in change.blacklist):
+                        raise ValueError("is listed twice")
+                    change.blacklist.append([color, parse_tolerance(entry[1])])
+                except ValueError as e:
+                    problems.append(f"blacklist entry `{json.dumps(entry)}` {e}")
+            continue
+        name = SETTING_NAMES.get(key.lower())
+        if name is None:
+            problems.append(f"`{key}` is not a setting")
+            continue
+        try:
+            change.settings[name] = SETTINGS[name](value)
+        except ValueError as e:
+            problems.append(f"`{key}` {e}")
+    if problems:
+        raise ConfigError(problems)
+    return change
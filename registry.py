@@ -0,0 +1,127 @@
+import time
+from collections import OrderedDict
+
+
+class RaveRegistry:
+    def __init__(self, factory, maxResident=10000, idleTtl=3600.0, can_evict=None):
+        """
+        Bounded set of the guilds' Raves. Guilds are loaded on first use and kept in least-recently-used order; when
+        there are more than maxResident of them, or the least recently used one has been idle for idleTtl seconds,
+        it is dropped and will be reloaded from storage the next time it is needed.
+
+        :param factory: Function building the Rave of a guild
+        :param maxResident: Maximum number of Raves kept in memory
+        :param idleTtl: Seconds after which an unused Rave is dropped
+        :param can_evict: Function telling whether a Rave can be dropped yet (e.g. it has no unsaved changes)
+        """
+        self.factory = factory
+        self.maxResident = maxResident
+        self.idleTtl = idleTtl
+        self.can_evict = can_evict if can_evict is not None else (lambda rave: True)
+        self.entries = OrderedDict()  # Guild ID -> [rave, last use], least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nextTrim = 0.0  # Time after which a hit also looks for idle guilds
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, guild_id):
+        return guild_id in self.entries
+
+    def __iter__(self):
+        return (entry[0] for entry in self.entries.values())
+
+    def get(self, guild):
+        """
+        Find the Rave of a guild, loading it if needed
+
+        :param guild: The guild
+        :return: The guild's Rave
+        """
+        now = time.monotonic()
+        entry = self.entries.get(guild.id)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = now
+            self.entries.move_to_end(guild.id)
+
+            # Idle guilds only need to be looked for now and then
+            if now < self.nextTrim:
+                return entry[0]
+        else:
+            self.misses += 1
+            entry = [self.factory(guild), now]
+            self.entries[guild.id] = entry
+        self.trim(now)
+        return entry[0]
+
+    def find(self, guild_id):
+        """
+        Find the Rave of a guild without loading it or counting as a use
+
+        :param guild_id: ID of the guild
+        :return: The guild's Rave, or None if it isn't loaded
+        """
+        entry = self.entries.get(guild_id)
+        return entry[0] if entry is not None else None
+
+    def add(self, guild_id, rave):
+        """
+        Insert an already loaded Rave
+
+        :param guild_id: ID of the guild
+        :param rave: The guild's Rave
+        :return: None
+        """
+        self.entries[guild_id] = [rave, time.monotonic()]
+        self.entries.move_to_end(guild_id)
+        self.trim(time.monotonic())
+
+    def evict(self, guild_id):
+        """
+        Drop the Rave of a guild right away (e.g. when the bot leaves it)
+
+        :param guild_id: ID of the guild
+        :return: The dropped Rave, or None if it wasn't loaded
+        """
+        entry = self.entries.pop(guild_id, None)
+        if entry is None:
+            return None
+        self.evictions += 1
+        return entry[0]
+
+    def trim(self, now):
+        """
+        Drop least recently used Raves while there are too many or they are idle. Raves that can't be dropped yet
+        are moved to the back to be retried later, so this looks at a bounded number of entries.
+
+        :param now: Current time.monotonic()
+        :return: None
+        """
+        self.nextTrim = now + 1.0
+        skipped = 0
+        while self.entries and skipped < 8:
+            guild_id, (rave, last_use) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.maxResident and now - last_use < self.idleTtl:
+                break
+            if self.can_evict(rave):
+                del self.entries[guild_id]
+                self.evictions += 1
+            else:
+                self.entries.move_to_end(guild_id)
+                skipped += 1
+
+    def stats(self):
+        """
+        Counters of the registry
+
+        :return: Dict of counters
+        """
+        return {
+            "resident": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
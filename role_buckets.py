@@ -0,0 +1,138 @@
+import random
+import asyncio
+import traceback
+import discord
+
+BUCKET_ROLE_NAME = "Rave Bucket"  # Bucket roles are named "Rave Bucket 1", "Rave Bucket 2"...
+
+
+def bucket_number(name):
+    """
+    :param name: Name of a role
+    :return: The bucket number in the name (1 for "Rave Bucket 1"), or None if it isn't a bucket role's name
+    """
+    prefix, _, number = name.rpartition(' ')
+    if prefix == BUCKET_ROLE_NAME and number.isdigit() and number[0] != '0':
+        return int(number)
+    return None
+
+
+class BucketRoles:
+    def __init__(self):
+        """
+        Fixed set of shared color roles of a guild. A rave moves the member into another bucket (adding the new
+        bucket role and removing the old one) instead of recoloring a role of their own, and the bucket colors rotate
+        every so often in one pass over the buckets, so the role count and the API calls per message stay the same
+        however large the guild is.
+        """
+        self.roles = {}  # Bucket number -> role
+        self.raved = False  # Whether a member changed buckets since the colors last rotated
+        self.task = None  # Task rotating the colors, None while idle
+
+    def load(self, roles):
+        """
+        (Re)load the bucket roles from the guild's roles, e.g. ones left over from a previous run
+
+        :param roles: Every role of the guild
+        :return: None
+        """
+        self.roles = {}
+        for role in roles:
+            number = bucket_number(role.name)
+            if number is not None and number not in self.roles:
+                self.roles[number] = role
+
+    def forget(self, role):
+        """
+        Drop a bucket role that was deleted
+
+        :param role: The role
+        :return: None
+        """
+        for number, bucket in list(self.roles.items()):
+            if bucket.id == role.id:
+                del self.roles[number]
+
+    def member_bucket(self, member):
+        """
+        :param member: The member
+        :return: The bucket role the member is in, or None if they aren't in any
+        """
+        for role in self.roles.values():
+            if member._roles.has(role.id):
+                return role
+        return None
+
+    async def ensure(self, server, rave):
+        """
+        Create the missing bucket roles, then move them with a single edit_role_positions call.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :return: List of the guild's rave.bucketCount bucket roles
+        """
+        bucket = rave.roleQueue.bucket
+        created = []
+        for number in range(1, rave.bucketCount + 1):
+            if number not in self.roles:
+                await bucket.acquire()
+                role = await server.create_role(name=f"{BUCKET_ROLE_NAME} {number}",
+                                                colour=discord.Colour(rave.colorSampler.sample()))
+                rave.roleIndex.add(role)
+                self.roles[number] = role
+                created.append(role)
+
+        if created and rave.moveRole:
+            await bucket.acquire()
+            position = rave.rave_role_position(server)
+            await server.edit_role_positions(positions={role: position for role in created})
+        return [self.roles[number] for number in range(1, rave.bucketCount + 1)]
+
+    async def move(self, server, member, rave):
+        """
+        Move a member to another bucket. Called by the guild's role queue, possibly long after the message, so only
+        the bucket roles are touched: replacing the member's whole role list would undo any role change made since.
+
+        :param server: The guild
+        :param member: The member raving
+        :param rave: The guild's Rave
+        :return: None
+        """
+        buckets = await self.ensure(server, rave)
+        current = [role for role in self.roles.values() if member._roles.has(role.id)]
+        choices = [role for role in buckets if role not in current] or buckets
+        target = random.choice(choices)
+
+        # Add first so the member is never left without a color
+        if target not in current:
+            await member.add_roles(target)
+        previous = [role for role in current if role is not target]
+        if previous:
+            await member.remove_roles(*previous)
+
+        self.raved = True
+        if rave.bucketRotate > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.get_event_loop().create_task(self.rotate(server, rave))
+
+    async def rotate(self, server, rave):
+        """
+        Every rave.bucketRotate seconds, give every bucket a new color, for as long as members keep raving.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :return: None
+        """
+        bucket = rave.roleQueue.bucket
+        try:
+            while rave.bucketRotate > 0:
+                await asyncio.sleep(rave.bucketRotate)
+                if not self.raved:
+                    break
+                self.raved = False
+                for number, role in sorted(self.roles.items()):
+                    if number > rave.bucketCount:
+                        continue
+                    await bucket.acquire()
+                    await role.edit(colour=discord.Colour(rave.colorSampler.sample()))
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,151 @@
+import time
+import traceback
+import discord
+
+DAY = 86400  # Seconds
+
+
+def today():
+    """
+    :return: Days since the epoch, the unit rave roles' last use is kept in
+    """
+    return int(time.time() // DAY)
+
+
+class RoleSweeper:
+    def __init__(self):
+        """
+        Finds and deletes a guild's stale rave roles: roles left behind by members who left the guild or renamed
+        themselves (raving again under the new name creates a new role), and roles nobody raved with for a while.
+
+        Only the roles the bot created, renamed or recolored as a member's rave role are ever swept, never a role that
+        merely looks like a member's name. Which member a role belongs to is only known for the roles used since the guild was loaded, so
+        roles from before a restart are only ever found stale once they have been idle long enough. Members who left
+        are only spotted directly when the whole member list is cached (see gateway.py); otherwise their roles go idle
+        too.
+        """
+        self.roleMember = {}  # Rave role ID -> ID of the member it was last applied to
+        self.memberRole = {}  # Member ID -> ID of the rave role last applied to them
+        # Rave role ID -> day it was last used (see today()), for the roles the bot adopted. Saved with the guild's
+        # variables
+        self.lastRave = {}
+        self.unsaved = False  # Whether lastRave changed since the guild's variables were last saved
+        self.reclaimed = 0  # Roles deleted since the guild was loaded
+        self.sweeping = False  # Whether a sweep is running
+
+    def adopt(self, role):
+        """
+        Note that the bot created a rave role, renamed a spare into one or recolored one, which makes it eligible for
+        sweeping
+
+        :param role: The role
+        :return: None
+        """
+        if role.id not in self.lastRave:
+            self.lastRave[role.id] = today()
+            self.unsaved = True
+
+    def used(self, role, member):
+        """
+        Note that a member raved with a role. lastRave only changes the first time a role is used each day, and only
+        for the roles the bot adopted.
+
+        :param role: The member's rave role
+        :param member: The member
+        :return: None
+        """
+        self.roleMember[role.id] = member.id
+        self.memberRole[member.id] = role.id
+        day = today()
+        if role.id in self.lastRave and self.lastRave[role.id] != day:
+            self.lastRave[role.id] = day
+            self.unsaved = True
+
+    def forget(self, role_id):
+        """
+        Drop what is known about a deleted role
+
+        :param role_id: ID of the role
+        :return: None
+        """
+        member_id = self.roleMember.pop(role_id, None)
+        if member_id is not None and self.memberRole.get(member_id) == role_id:
+            del self.memberRole[member_id]
+        if self.lastRave.pop(role_id, None) is not None:
+            self.unsaved = True
+
+    def find_stale(self, server, rave, idle_days):
+        """
+        List the guild's stale rave roles, among the ones the bot adopted.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :param idle_days: Days without a rave after which a role is stale, 0 to never count roles as idle
+        :return: List of (role, reason) with reason "renamed", "left" or "idle"
+        """
+        index = rave.roleIndex
+        if not index.built:
+            index.rebuild(server.roles)
+        day = today()
+
+        # Roles deleted while the guild wasn't loaded
+        for role_id in [role_id for role_id in self.lastRave if role_id not in index.byId]:
+            self.forget(role_id)
+
+        names = {str(member) for member in server.members} if server.chunked else None
+        top = server.me.top_role if server.me is not None else None
+        pending = rave.roleQueue.pending
+
+        stale = []
+        for role_id, lastRave in list(self.lastRave.items()):
+            role = index.get_id(role_id)
+            if role is None or role.managed or role.id == rave.requiredRoleId or (top is not None and not role < top):
+                continue
+            member_id = self.roleMember.get(role_id)
+            if member_id is not None and member_id in pending:
+                continue
+
+            if member_id is not None and self.memberRole.get(member_id) != role_id:
+                stale.append((role, "renamed"))
+            elif names is not None and role.name not in names:
+                stale.append((role, "left"))
+            elif idle_days > 0 and day - lastRave >= idle_days:
+                stale.append((role, "idle"))
+        return stale
+
+    async def sweep(self, server, rave, idle_days, limit=None):
+        """
+        Delete the guild's stale rave roles, paced by the guild's rate-limit bucket like every other role edit.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :param idle_days: Days without a rave after which a role is stale, 0 to never count roles as idle
+        :param limit: Most roles to delete, None for no limit
+        :return: List of (role, reason) of the deleted roles
+        """
+        bucket = rave.roleQueue.bucket
+        deleted = []
+        self.sweeping = True
+        try:
+            for role, reason in self.find_stale(server, rave, idle_days)[:limit]:
+                await bucket.acquire()
+
+                # The member may have raved again while waiting for the bucket
+                if self.roleMember.get(role.id) in rave.roleQueue.pending \
+                        or (reason == "idle" and self.lastRave.get(role.id) == today()):
+                    continue
+                try:
+                    await role.delete(reason=f"Stale rave role ({reason})")
+                except discord.NotFound:
+                    pass
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                else:
+                    deleted.append((role, reason))
+                rave.roleIndex.remove(role)
+                self.forget(role.id)
+        finally:
+            self.sweeping = False
+        self.reclaimed += len(deleted)
+        return deleted
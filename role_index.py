@@ -0,0 +1,151 @@
+from bisect import bisect_left, insort
+
+
+class RoleIndex:
+    def __init__(self):
+        """
+        Name -> role and ID -> role index of a guild's roles, kept current by the role events so lookups don't
+        have to scan guild.roles.
+        """
+        self.byId = {}  # Role ID -> role
+        self.byName = {}  # Role name -> {role ID: role}, since several roles can share a name
+        self.built = False  # Whether the index has been filled from the guild yet
+        self.memberNames = []  # Sorted (lowercase member name, role ID) of the rave roles, for !color lookups
+        self.memberKeys = {}  # Rave role ID -> its key in memberNames
+
+    def rebuild(self, roles):
+        """
+        Refill the index from scratch
+
+        :param roles: Every role of the guild
+        :return: None
+        """
+        self.byId = {}
+        self.byName = {}
+        self.memberNames = []
+        self.memberKeys = {}
+        for role in roles:
+            self.add(role)
+        self.built = True
+
+    def add(self, role):
+        """
+        Index a created role
+
+        :param role: The role
+        :return: None
+        """
+        self.byId[role.id] = role
+        self.byName.setdefault(role.name, {})[role.id] = role
+        self.add_member_name(role.id, role.name)
+
+    def remove(self, role):
+        """
+        Forget a deleted role
+
+        :param role: The role
+        :return: None
+        """
+        old = self.byId.pop(role.id, None)
+        for name in {role.name, old.name if old is not None else role.name}:
+            named = self.byName.get(name)
+            if named is not None:
+                named.pop(role.id, None)
+                if not named:
+                    del self.byName[name]
+        self.remove_member_name(role.id)
+
+    def update(self, before, after):
+        """
+        Follow a role update (e.g. a rename)
+
+        :param before: The role before the update
+        :param after: The role after the update
+        :return: None
+        """
+        self.remove(before)
+        self.add(after)
+
+    def rename(self, role, name):
+        """
+        Index a role under a new name before Discord confirms the rename with a role update event
+
+        :param role: The role
+        :param name: Its new name
+        :return: None
+        """
+        self.remove(role)
+        self.byId[role.id] = role
+        self.byName.setdefault(name, {})[role.id] = role
+        self.add_member_name(role.id, name)
+
+    def add_member_name(self, role_id, name):
+        """
+        Index a rave role (named after a member, like "name#1234", or "name#0" for accounts on the new username
+        system) by its lowercase member name
+
+        :param role_id: ID of the role
+        :param name: Name of the role
+        :return: None
+        """
+        # A role can be indexed twice (e.g. by apply_member_color, then by its role create event)
+        self.remove_member_name(role_id)
+        member_name, separator, discriminator = name.rpartition('#')
+        if separator and member_name and discriminator.isdigit():
+            key = member_name.lower()
+            self.memberKeys[role_id] = key
+            insort(self.memberNames, (key, role_id))
+
+    def remove_member_name(self, role_id):
+        """
+        Forget the member name of a rave role, if it had one
+
+        :param role_id: ID of the role
+        :return: None
+        """
+        key = self.memberKeys.pop(role_id, None)
+        if key is not None:
+            i = bisect_left(self.memberNames, (key, role_id))
+            if i < len(self.memberNames) and self.memberNames[i] == (key, role_id):
+                del self.memberNames[i]
+
+    def find_members(self, query):
+        """
+        Find rave roles by member name, ignoring case and the discriminator. Exact matches win over prefix matches.
+
+        :param query: Member name, or the start of one
+        :return: List of the matching roles, several if the name is ambiguous
+        """
+        query = query.lower()
+        start = bisect_left(self.memberNames, (query,))
+        exact = []
+        prefixed = []
+        for i in range(start, len(self.memberNames)):
+            key, role_id = self.memberNames[i]
+            if not key.startswith(query):
+                break
+            (exact if key == query else prefixed).append(self.byId[role_id])
+        return exact or prefixed
+
+    def get(self, name):
+        """
+        Find a role by name. Like discord.utils.get on guild.roles, the lowest role wins if several share the name.
+
+        :param name: Name of the role
+        :return: The role, or None if there is none with that name
+        """
+        named = self.byName.get(name)
+        if not named:
+            return None
+        if len(named) == 1:
+            return next(iter(named.values()))
+        return min(named.values())
+
+    def get_id(self, role_id):
+        """
+        Find a role by ID
+
+        :param role_id: ID of the role
+        :return: The role, or None if it doesn't exist
+        """
+        return self.byId.get(role_id)
@@ -0,0 +1,88 @@
+import asyncio
+import traceback
+
+SPARE_ROLE_NAME = "Rave Spare"  # Name of the pre-created roles waiting for a member
+
+
+class RolePool:
+    def __init__(self):
+        """
+        Spare rave roles of a guild, created and positioned ahead of time so a member raving for the first time only
+        needs their spare renamed and recolored (one edit) and assigned.
+        """
+        self.spares = []  # Spare roles ready to be handed out
+        self.task = None  # Task refilling the pool, None while idle
+
+    def load(self, roles):
+        """
+        (Re)load the spare roles from the guild's roles, e.g. ones left over from a previous run
+
+        :param roles: Every role of the guild
+        :return: None
+        """
+        self.spares = [role for role in roles if role.name == SPARE_ROLE_NAME]
+
+    def take(self):
+        """
+        Hand out a spare role
+
+        :return: A spare role, or None if the pool is empty
+        """
+        return self.spares.pop() if self.spares else None
+
+    def put_back(self, role):
+        """
+        Return a spare role that could not be handed out (e.g. renaming it failed)
+
+        :param role: The role
+        :return: None
+        """
+        if all(spare.id != role.id for spare in self.spares):
+            self.spares.append(role)
+
+    def forget(self, role):
+        """
+        Drop a spare role that was deleted
+
+        :param role: The role
+        :return: None
+        """
+        self.spares = [spare for spare in self.spares if spare.id != role.id]
+
+    def replenish(self, server, rave):
+        """
+        Start refilling the pool in the background, unless it is already being refilled.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :return: None
+        """
+        if len(self.spares) < rave.poolSize and (self.task is None or self.task.done()):
+            self.task = asyncio.get_event_loop().create_task(self.fill(server, rave))
+
+    async def fill(self, server, rave):
+        """
+        Create the missing spare roles, then move all of them with a single edit_role_positions call.
+
+        :param server: The guild
+        :param rave: The guild's Rave
+        :return: None
+        """
+        bucket = rave.roleQueue.bucket
+        created = []
+        try:
+            while len(self.spares) + len(created) < rave.poolSize:
+                await bucket.acquire()
+                role = await server.create_role(name=SPARE_ROLE_NAME)
+                rave.roleIndex.add(role)
+                created.append(role)
+
+            if created and rave.moveRole:
+                await bucket.acquire()
+                position = rave.rave_role_position(server)
+                await server.edit_role_positions(positions={role: position for role in created})
+        except Exception:
+            traceback.print_exc()
+        finally:
+            spare_ids = {role.id for role in self.spares}
+            self.spares.extend(role for role in created if role.id not in spare_ids)
@@ -0,0 +1,188 @@
+import asyncio
+import time
+import traceback
+import discord
+
+
+class RateBucket:
+    def __init__(self, limit=10, period=10.0):
+        """
+        Client-side estimate of a Discord rate-limit bucket. Tokens refill all at once every period, and a 429
+        empties the bucket until the retry-after has passed.
+
+        :param limit: Requests allowed per period
+        :param period: Length of the period (seconds)
+        """
+        self.limit = limit
+        self.period = period
+        self.remaining = limit
+        self.resetAt = time.monotonic() + period
+
+    def refill(self):
+        """
+        Refill the bucket if its reset time has passed
+
+        :return: None
+        """
+        now = time.monotonic()
+        if now >= self.resetAt:
+            self.remaining = self.limit
+            self.resetAt = now + self.period
+
+    def headroom(self):
+        """
+        Number of requests that can be sent right now without waiting
+
+        :return: Remaining requests in the current period
+        """
+        self.refill()
+        return self.remaining
+
+    async def acquire(self):
+        """
+        Wait until the bucket has room, then take one request from it.
+
+        :return: None
+        """
+        while self.headroom() <= 0:
+            await asyncio.sleep(max(self.resetAt - time.monotonic(), 0))
+        self.remaining -= 1
+
+    def backoff(self, retry_after):
+        """
+        Empty the bucket after Discord answered with a 429
+
+        :param retry_after: Seconds to wait before the next request
+        :return: None
+        """
+        self.remaining = 0
+        self.resetAt = time.monotonic() + retry_after
+
+
+class PendingBudget:
+    def __init__(self, limit=None):
+        """
+        Limit on the updates pending across every RoleQueue sharing it
+
+        :param limit: Maximum number of pending updates, None for no limit
+        """
+        self.limit = limit
+        self.used = 0  # Updates pending in the queues sharing the budget
+
+    def full(self):
+        """
+        :return: True if no more updates can be queued
+        """
+        return self.limit is not None and self.used >= self.limit
+
+
+class RoleQueue:
+    def __init__(self, bucket=None, limit=None, budget=None):
+        """
+        Per-guild queue of pending role updates. The message handler posts the colour a role should have and
+        returns right away; a worker task drains the queue at the pace the bucket allows. Posting again for a key
+        that is still pending replaces its colour (latest wins), so a burst of recolors costs one API call.
+
+        Under floods, updates for new keys are shed (dropped) once the queue holds limit of them, or once the shared
+        budget is used up. Updates for keys that are already pending are still merged into them.
+
+        :param bucket: RateBucket shared by every update of the guild
+        :param limit: Maximum number of pending updates of the guild, None for no limit
+        :param budget: PendingBudget shared with the other guilds' queues
+        """
+        self.bucket = bucket if bucket is not None else RateBucket()
+        self.limit = limit
+        self.budget = budget if budget is not None else PendingBudget()
+        self.pending = {}  # key -> (colour, apply) for updates that have not been sent yet
+        self.worker = None  # Task draining the queue, None while idle
+        self.posted = 0  # Updates posted to the queue
+        self.coalesced = 0  # Updates replaced by a newer one before being sent
+        self.sent = 0  # Updates applied through the API
+        self.shed = 0  # Updates dropped because the queue or the budget was full
+        self.onRateLimited = None  # Function called with the retry-after when an update gets a 429
+
+    @property
+    def depth(self):
+        """
+        Number of updates waiting to be sent
+
+        :return: Queue depth
+        """
+        return len(self.pending)
+
+    def post(self, key, colour, apply):
+        """
+        Queue an update without waiting for it.
+
+        :param key: What the update applies to (e.g. a role name or member ID); one update per key is kept
+        :param colour: The colour the role should end up with
+        :param apply: Coroutine function called with the colour to perform the API calls
+        :return: False if the update was shed, True otherwise
+        """
+        self.posted += 1
+        if key in self.pending:
+            self.coalesced += 1
+        elif (self.limit is not None and len(self.pending) >= self.limit) or self.budget.full():
+            self.shed += 1
+            return False
+        else:
+            self.budget.used += 1
+        self.pending[key] = (colour, apply)
+
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_event_loop().create_task(self.drain())
+        return True
+
+    async def drain(self):
+        """
+        Send pending updates, oldest key first, until the queue is empty.
+
+        :return: None
+        """
+        while self.pending:
+            await self.bucket.acquire()
+
+            # The queue may have been emptied while waiting for the bucket
+            if not self.pending:
+                break
+            key = next(iter(self.pending))
+            colour, apply = self.pending.pop(key)
+            self.budget.used -= 1
+
+            try:
+                await apply(colour)
+                self.sent += 1
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    try:
+                        retry_after = float(e.response.headers.get("Retry-After", self.bucket.period))
+                    except (AttributeError, TypeError, ValueError):
+                        retry_after = self.bucket.period
+                    self.bucket.backoff(retry_after)
+                    if self.onRateLimited is not None:
+                        self.onRateLimited(retry_after)
+
+                    # Retry unless a newer colour was posted in the meantime
+                    if key not in self.pending:
+                        self.pending[key] = (colour, apply)
+                        self.budget.used += 1
+                else:
+                    traceback.print_exc()
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        """
+        Summary of the queue for status messages
+
+        :return: Dict of queue counters
+        """
+        return {
+            "depth": self.depth,
+            "limit": self.limit,
+            "headroom": self.bucket.headroom(),
+            "posted": self.posted,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "shed": self.shed
+        }
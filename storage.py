@@ -0,0 +1,491 @@
+import os
+import re
+import sys
+import json
+import sqlite3
+import threading
+from persistence import write_file_atomic
+
+
+def create_old_file(filename):
+    """
+    Renames filename to filename_old. Appends numbers if filename_old exists
+
+    :param filename: Name of the file (without extension) to process
+    :return: None
+    """
+    newname = filename + "_old.json"
+    num = 1
+    while os.path.exists(newname):
+        newname = filename + "_old" + str(num) + ".json"
+        num += 1
+    os.rename(filename + ".json", newname)
+
+
+def load_file(filename):
+    """
+    Handles loading a json file, including cases where the file doesn't exist or is corrupted.
+
+    :param filename: Name of the file without extension
+    :return: A list generated from the json data in the file.
+    """
+    file_list = []
+    try:
+        print(f"Opening {filename}.json... ", end='')
+        file = open(f"{filename}.json", "r")
+        file_list = json.load(file)
+        file.close()
+    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        print("error:")
+
+        # Create it if it is missing
+        if isinstance(e, FileNotFoundError):
+            print(f"File {filename}.json not found, creating it... ", end='')
+
+        # Recreate it if the file is bad
+        elif isinstance(e, json.decoder.JSONDecodeError):
+            print(f"WARNING: {filename}.json file corrupted, re-creating it... ", end='')
+            file.close()
+            create_old_file(filename)
+
+        # Initialize the file
+        file = open(f"{filename}.json", "w")
+        json.dump([], file)
+        file.close()
+        file_list = []
+    finally:
+        print("done.")
+        return file_list
+
+
+def replay_opt_out(opt_out_list, changes):
+    """
+    Apply journaled opt-out changes to an opt-out list
+
+    :param opt_out_list: List of IDs of the members who opted out
+    :param changes: List of (member ID, opted out) pairs, oldest first
+    :return: The updated list, in the original order with new IDs at the end
+    """
+    if not changes:
+        return opt_out_list
+    opt_out = dict.fromkeys(opt_out_list)
+    for member_id, opted_out in changes:
+        if opted_out:
+            opt_out[member_id] = None
+        else:
+            opt_out.pop(member_id, None)
+    return list(opt_out)
+
+
+class Storage:
+    """
+    Interface of the guild state backends. Guilds are identified by the "<id>.<name>" server string used by Rave.
+    Loads are called from the event loop; saves are called from the write-behind's executor thread.
+    """
+
+    def has_guild(self, server):
+        """
+        :param server: Server string
+        :return: True if the guild has saved state
+        """
+        raise NotImplementedError
+
+    def load_variables(self, server):
+        """
+        :param server: Server string
+        :return: List of (name, value) pairs, empty if the guild has no saved settings
+        """
+        raise NotImplementedError
+
+    def save_variables(self, server, variables_list):
+        """
+        :param server: Server string
+        :param variables_list: List of (name, value) pairs, as built by Rave.save_variables
+        :return: None
+        """
+        raise NotImplementedError
+
+    def load_opt_out(self, server):
+        """
+        :param server: Server string
+        :return: List of IDs of the members who opted out
+        """
+        raise NotImplementedError
+
+    def save_opt_out(self, server, opt_out_list):
+        """
+        :param server: Server string
+        :param opt_out_list: List of IDs of the members who opted out
+        :return: None
+        """
+        raise NotImplementedError
+
+    def append_opt_out(self, server, changes):
+        """
+        Record opt-out changes without rewriting the whole list
+
+        :param server: Server string
+        :param changes: List of (member ID, opted out) pairs, oldest first
+        :return: None
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the backend's resources
+
+        :return: None
+        """
+        pass
+
+
+class JsonStorage(Storage):
+    """
+    The original layout: a variables_<server>.json and an opt_out_<server>.json file per guild.
+
+    Opt-out changes are appended to an opt_out_<server>.journal file as "+<id>" and "-<id>" lines, which are replayed
+    on top of the json snapshot when loading. Once the journal grows past journal_limit bytes, it is folded into the
+    snapshot and emptied. Replaying a record the snapshot already has is harmless, so a crash between the two steps
+    loses nothing.
+    """
+
+    def __init__(self, directory=".", journal_limit=64 * 1024):
+        self.directory = directory
+        self.journalLimit = journal_limit  # Journal size (bytes) past which it is compacted
+
+    def path(self, kind, server):
+        return os.path.join(self.directory, f"{kind}_{server}")
+
+    def has_guild(self, server):
+        return os.path.exists(self.path("variables", server) + ".json") \
+            or os.path.exists(self.path("opt_out", server) + ".json")
+
+    def load_variables(self, server):
+        return load_file(self.path("variables", server))
+
+    def save_variables(self, server, variables_list):
+        write_file_atomic(self.path("variables", server) + ".json", json.dumps(variables_list))
+
+    def load_opt_out(self, server):
+        opt_out_list = load_file(self.path("opt_out", server))
+        return replay_opt_out(opt_out_list, self.read_journal(server))
+
+    def save_opt_out(self, server, opt_out_list):
+        write_file_atomic(self.path("opt_out", server) + ".json", json.dumps(opt_out_list))
+        # The snapshot now holds everything the journal did
+        with open(self.path("opt_out", server) + ".journal", "w"):
+            pass
+
+    def append_opt_out(self, server, changes):
+        records = "".join(f"{'+' if opted_out else '-'}{member_id}\n" for member_id, opted_out in changes)
+        with open(self.path("opt_out", server) + ".journal", "ab+") as file:
+            # Drop the last record if a crash cut it short (records are at most 21 bytes long)
+            size = file.seek(0, os.SEEK_END)
+            if size > 0:
+                file.seek(max(size - 32, 0))
+                tail = file.read()
+                if not tail.endswith(b"\n"):
+                    file.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+            file.write(records.encode())
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        if size > self.journalLimit:
+            self.save_opt_out(server, self.load_opt_out(server))
+
+    def read_journal(self, server):
+        """
+        Read a guild's opt-out journal. A last line cut short by a crash is skipped.
+
+        :param server: Server string
+        :return: List of (member ID, opted out) pairs, oldest first
+        """
+        try:
+            with open(self.path("opt_out", server) + ".journal", "r") as file:
+                lines = file.read().split("\n")
+        except FileNotFoundError:
+            return []
+        lines.pop()  # Empty unless the last record was not finished
+        changes = []
+        for line in lines:
+            if line[1:].isdigit() and line[:1] in ("+", "-"):
+                changes.append((int(line[1:]), line[0] == "+"))
+        return changes
+
+
+class SqliteStorage(Storage):
+    """
+    Every guild in one SQLite database (WAL mode). Settings, blacklist entries and opt-outs are rows keyed by guild
+    ID, so loads are indexed lookups and saves only touch the rows that changed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            guild INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS blacklist (
+            guild INTEGER NOT NULL,
+            r INTEGER NOT NULL,
+            g INTEGER NOT NULL,
+            b INTEGER NOT NULL,
+            tolerance REAL NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (guild, r, g, b)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS opt_out (
+            guild INTEGER NOT NULL,
+            member INTEGER NOT NULL,
+            PRIMARY KEY (guild, member)
+        ) WITHOUT ROWID;
+    """
+
+    # Derived from the blacklist when loading, so not worth storing
+    DERIVED = ("blacklist_range",)
+
+    def __init__(self, path="rolerave.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.db.commit()
+
+    @staticmethod
+    def guild_key(server):
+        """
+        Guild ID part of a server string, so renaming a guild keeps its rows
+
+        :param server: Server string
+        :return: Guild ID
+        """
+        return int(str(server).split('.', 1)[0])
+
+    def has_guild(self, server):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM settings WHERE guild = ? LIMIT 1", (self.guild_key(server),)).fetchone()
+        return row is not None
+
+    def load_variables(self, server):
+        guild = self.guild_key(server)
+        with self.lock:
+            settings = self.db.execute("SELECT name, value FROM settings WHERE guild = ?", (guild,)).fetchall()
+            blacklist = self.db.execute(
+                "SELECT r, g, b, tolerance FROM blacklist WHERE guild = ? ORDER BY position", (guild,)
+            ).fetchall()
+
+        if not settings:
+            return []
+        variables_list = [(name, json.loads(value)) for name, value in settings]
+        variables_list.append(("blacklist", [[(r, g, b), tolerance] for r, g, b, tolerance in blacklist]))
+        return variables_list
+
+    def save_variables(self, server, variables_list):
+        guild = self.guild_key(server)
+        with self.lock, self.db:
+            current = dict(self.db.execute("SELECT name, value FROM settings WHERE guild = ?", (guild,)))
+            for name, value in variables_list:
+                if name in self.DERIVED:
+                    continue
+                if name == "blacklist":
+                    self.save_blacklist(guild, value)
+                    continue
+                value = json.dumps(value)
+                if current.get(name) != value:
+                    self.db.execute(
+                        "INSERT INTO settings (guild, name, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (guild, name) DO UPDATE SET value = excluded.value",
+                        (guild, name, value)
+                    )
+
+    def save_blacklist(self, guild, blacklist):
+        """
+        Bring the guild's blacklist rows in line with blacklist. Must be called with the lock held, in a transaction.
+
+        :param guild: Guild ID
+        :param blacklist: [(r, g, b), tolerance] list
+        :return: None
+        """
+        current = {
+            (r, g, b): (tolerance, position) for r, g, b, tolerance, position
+            in self.db.execute("SELECT r, g, b, tolerance, position FROM blacklist WHERE guild = ?", (guild,))
+        }
+        wanted = {tuple(entry[0]): (entry[1], position) for position, entry in enumerate(blacklist)}
+
+        for color in current.keys() - wanted.keys():
+            self.db.execute("DELETE FROM blacklist WHERE guild = ? AND r = ? AND g = ? AND b = ?", (guild, *color))
+        for color, row in wanted.items():
+            if current.get(color) != row:
+                self.db.execute(
+                    "INSERT INTO blacklist (guild, r, g, b, tolerance, position) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (guild, r, g, b) DO UPDATE SET tolerance = excluded.tolerance, "
+                    "position = excluded.position",
+                    (guild, *color, *row)
+                )
+
+    def load_opt_out(self, server):
+        with self.lock:
+            rows = self.db.execute("SELECT member FROM opt_out WHERE guild = ?", (self.guild_key(server),)).fetchall()
+        return [row[0] for row in rows]
+
+    def save_opt_out(self, server, opt_out_list):
+        guild = self.guild_key(server)
+        with self.lock, self.db:
+            current = {row[0] for row in self.db.execute("SELECT member FROM opt_out WHERE guild = ?", (guild,))}
+            wanted = set(opt_out_list)
+            self.db.executemany(
+                "DELETE FROM opt_out WHERE guild = ? AND member = ?", [(guild, m) for m in current - wanted]
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO opt_out (guild, member) VALUES (?, ?)", [(guild, m) for m in wanted - current]
+            )
+
+    def append_opt_out(self, server, changes):
+        guild = self.guild_key(server)
+        with self.lock, self.db:
+            for member_id, opted_out in changes:
+                if opted_out:
+                    self.db.execute("INSERT OR IGNORE INTO opt_out (guild, member) VALUES (?, ?)", (guild, member_id))
+                else:
+                    self.db.execute("DELETE FROM opt_out WHERE guild = ? AND member = ?", (guild, member_id))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def create_storage(backend="json", path="rolerave.db"):
+    """
+    Build the storage backend selected in the settings
+
+    :param backend: "json" or "sqlite"
+    :param path: Database file for the sqlite backend
+    :return: Storage
+    """
+    if backend == "sqlite":
+        return SqliteStorage(path)
+    elif backend == "json":
+        return JsonStorage()
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+# variables_<server>.json, opt_out_<server>.json and their _old, _old1, _old2... copies
+JSON_FILE = re.compile(r"^(variables|opt_out)_(\d+\..*?)(_old(\d*))?\.json$")
+
+
+def read_json_list(path):
+    """
+    Read a json file without repairing it
+
+    :param path: Path of the file
+    :return: The list in the file (possibly empty), or None if it is missing or unreadable
+    """
+    try:
+        with open(path, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, list) else None
+
+
+def import_json(storage, directory="."):
+    """
+    One-shot migration of the json files of a directory into storage. For each guild, the current file is used
+    if it is readable; otherwise the newest readable _old copy made by create_old_file is. Guilds that already have
+    settings in storage are left alone, so running it twice is harmless.
+
+    :param storage: Destination SqliteStorage
+    :param directory: Directory holding the json files
+    :return: Number of guilds imported
+    """
+    candidates = {}  # (kind, server) -> [(rank, path)], lowest rank tried first
+    for filename in os.listdir(directory):
+        match = JSON_FILE.match(filename)
+        if match is None:
+            continue
+        kind, server, old, num = match.groups()
+        if old is None:
+            rank = 0
+        else:
+            # _old is the first copy made, then _old1, _old2...: higher numbers are newer and are tried first
+            rank = 1_000_000 - (0 if num == "" else int(num) + 1)
+        candidates.setdefault((kind, server), []).append((rank, os.path.join(directory, filename)))
+
+    found = {}  # (kind, server) -> data
+    for key, paths in candidates.items():
+        paths.sort()
+        for rank, path in paths:
+            data = read_json_list(path)
+            if data is not None:
+                found[key] = data
+                break
+
+    journal = JsonStorage(directory)
+    imported = 0
+    for server in sorted({server for kind, server in candidates}):
+        if storage.has_guild(server):
+            continue
+        variables_list = found.get(("variables", server))
+        if variables_list is not None:
+            storage.save_variables(server, variables_list)
+        opt_out_list = found.get(("opt_out", server))
+        changes = journal.read_journal(server)
+        if changes:
+            opt_out_list = replay_opt_out(opt_out_list or [], changes)
+        if opt_out_list is not None:
+            storage.save_opt_out(server, opt_out_list)
+        if variables_list is not None or opt_out_list is not None:
+            print(f"Imported {server}.")
+            imported += 1
+    return imported
+
+
+def write_snapshot(path, states):
+    """
+    Write the state of every loaded guild to a single file, so the next start can restore them in one read
+
+    :param path: Path of the snapshot file
+    :param states: Dict of server string -> (opt-out list, variables list)
+    :return: None
+    """
+    write_file_atomic(path, json.dumps(
+        {server: {"opt_out": opt_out_list, "variables": variables_list}
+         for server, (opt_out_list, variables_list) in states.items()}
+    ))
+
+
+def read_snapshot(path):
+    """
+    Read and delete a snapshot written by write_snapshot. It is deleted right away because storage is the source of
+    truth again as soon as anything changes; a snapshot is only valid for the start that follows a clean shutdown.
+
+    :param path: Path of the snapshot file
+    :return: Dict of server string -> (opt-out list, variables list), empty if there is no readable snapshot
+    """
+    try:
+        with open(path, "r") as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        print(f"WARNING: snapshot {path} is unreadable, ignoring it.")
+        data = {}
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    if not isinstance(data, dict):
+        return {}
+    return {server: (state["opt_out"], state["variables"]) for server, state in data.items()}
+
+
+if __name__ == "__main__":
+    # python storage.py [json directory] [database]
+    directory = sys.argv[1] if len(sys.argv) > 1 else "."
+    database = sys.argv[2] if len(sys.argv) > 2 else "rolerave.db"
+    sqlite_storage = SqliteStorage(database)
+    print(f"Imported {import_json(sqlite_storage, directory)} guilds into {database}.")
+    sqlite_storage.close()